@@ -48,8 +48,11 @@ except ImportError:
     block_types_available = False
 
 from .inject import Injector
+from .network import DeltaPacer
+from .world import BlockDeltaQueue
 
 
+# initial number of block deltas sent per update, see DeltaPacer
 MAX_BLOCKS_AT_ONCE = 500
 
 
@@ -68,38 +71,39 @@ class CuBoltConnectionScript(ConnectionScript):
         self.chunks = []
         self.static_entities = []
 
-        self.block_deltas = []
-        self.__first_pos_update = True
+        self.block_deltas = BlockDeltaQueue()
+        self.delta_pacer = DeltaPacer(MAX_BLOCKS_AT_ONCE)
+        self.__chunk_pos = None
 
     def on_pos_update(self, event):
         p = self.connection.position
         pos_x = int(p.x / (BLOCK_SCALE * 256))
         pos_y = int(p.y / (BLOCK_SCALE * 256))
 
-        if self.__first_pos_update:
-            self.__first_pos_update = False
-            self.__chunk_pos = (pos_x, pos_y)
+        if (pos_x, pos_y) != self.__chunk_pos:
+            # request chunk data, the chunks around the player have
+            # usually been prefetched already
             w = self.server.world
             pos = Vector2(pos_x, pos_y)
             chunk = w.get_chunk(pos)
-            self.chunks.append(chunk)
-
-            def resend():
+            if chunk not in self.chunks:
                 self.chunks.append(chunk)
+            self.__chunk_pos = (pos_x, pos_y)
+            self.server.chunk_subscribers.subscribe(self, (pos_x, pos_y))
 
-            # re-send data after 30 seconds as slower machines may
-            # need some time to generate the chunk
-            self.parent.loop.call_later(30.0, resend)
-        else:
-            cp = self.__chunk_pos
-            if (pos_x,pos_y) != cp:
-                # request chunk data
-                w = self.server.world
-                pos = Vector2(pos_x, pos_y)
-                chunk = w.get_chunk(pos)
-                if chunk not in self.chunks:
-                    self.chunks.append(chunk)
-                self.__chunk_pos = (pos_x,pos_y)
+    def on_unload(self):
+        self.server.chunk_subscribers.unsubscribe(self)
+        # entities must not keep a disconnected player as viewer
+        connection = self.connection
+        grid = self.server.entity_grid
+        cell = None
+        if connection.entity is not None:
+            cell = grid.get_cell(connection.entity.entity_id)
+        if cell is None:
+            cell = self.__chunk_pos
+        if cell is not None:
+            for entity in grid.get_entities_near(cell):
+                entity.cubolt_entity.forget_viewer(connection)
 
     def on_entity_update(self, event):
         """Handles an entity update event.
@@ -110,12 +114,14 @@ class CuBoltConnectionScript(ConnectionScript):
         """
         self.entity.cubolt_entity.on_entity_update(event)
 
-    def send_update_packet(self, update_packet):
+    def send_update_packet(self, update_packet, encoder=None):
         """Creates and sends an individual update packet for this
         client.
         
         Keyword arguments:
         update_packet -- Update packet to send.
+        encoder -- UpdatePacketEncoder holding the encoded shared
+            sections of update_packet, None to encode the whole packet.
 
         """
         not_loaded_chunks = []
@@ -126,6 +132,34 @@ class CuBoltConnectionScript(ConnectionScript):
                 chunk._append_deltas(self.block_deltas)
         self.chunks = not_loaded_chunks
 
+        queue = self.block_deltas
+        budget = self.delta_pacer.get_budget(self.connection.transport,
+                                             len(queue))
+        block_deltas = queue.pop_many(budget, self.__chunk_pos)
+
+        if encoder is not None:
+            # only the client specific sections need to be encoded
+            data = encoder.encode({
+                'items_1' : block_deltas,
+                'particles' : self.particles,
+                'static_entities' : self.static_entities,
+            })
+            self.connection.transport.write(data)
+        else:
+            self.__send_merged_packet(update_packet, block_deltas)
+
+        self.particles.clear()
+        self.static_entities.clear()
+
+    def __send_merged_packet(self, update_packet, block_deltas):
+        """Sends the update packet with the client specific data merged
+        into it.
+        
+        Keyword arguments:
+        update_packet -- Update packet to send.
+        block_deltas -- Block deltas to send to this client.
+
+        """
         # backup non player specific data
         block_deltas_backup = update_packet.items_1
         if block_deltas_backup is None:
@@ -138,10 +172,6 @@ class CuBoltConnectionScript(ConnectionScript):
             static_entities_backup = []
 
         # generate new data
-        delta_count = len(self.block_deltas)
-        block_deltas = self.block_deltas[0:min(MAX_BLOCKS_AT_ONCE,
-                                               delta_count)]
-        del self.block_deltas[0:min(MAX_BLOCKS_AT_ONCE, delta_count)]
         block_deltas.extend(block_deltas_backup)
         update_packet.items_1 = block_deltas
 
@@ -159,9 +189,6 @@ class CuBoltConnectionScript(ConnectionScript):
         update_packet.particles = particle_backup
         update_packet.static_entities = static_entities_backup
 
-        self.particles.clear()
-        self.static_entities.clear()
-
     def is_near(self, x, y):
         """Checks whether a client is near a given chunk.
         
@@ -170,19 +197,16 @@ class CuBoltConnectionScript(ConnectionScript):
         y -- Chunk y coordinate.
 
         Returns:
-        True, if the player is near the chunk, otherwise False.
+        True, if the player is near the chunk, otherwise False. Players
+        whose position isn't known yet aren't near any chunk.
 
         """
-        c = self.connection
-        if c is not None:
-            chunk = c.chunk
-            if chunk is not None:
-                c_pos = chunk.pos
-                if abs(x - c_pos.x) < 3 and abs(y - c_pos.y) < 3:
-                    return True
-                else:
-                    return False
-        return True
+        subscribers = self.server.chunk_subscribers
+        cell = subscribers.get_cell(self)
+        if cell is None:
+            return False
+        r = subscribers.radius
+        return abs(x - cell[0]) <= r and abs(y - cell[1]) <= r
         
         
 class CuBoltServerScript(ServerScript):
@@ -220,6 +244,10 @@ class CuBoltServerScript(ServerScript):
         
         needed = time.time() - begin
         print('[CB] Done (%.2fs).' % needed)
+
+    def on_unload(self):
+        """Saves all pending block edits."""
+        self.injector.close()
         
         
 def get_class():
@@ -40,6 +40,7 @@ from cuwo.entity import POS_FLAG
 from cuwo.packet import EntityUpdate
 from cuwo.packet import HitPacket
 from cuwo.packet import HIT_NORMAL
+from cuwo.packet import write_packet
 from cuwo.static import StaticEntityPacket
 from cuwo.static import StaticEntityHeader
 from cuwo.static import ORIENT_SOUTH
@@ -155,6 +156,132 @@ NATIVE_SETTING_MAPPING = {
 MASK_HOSTILITY_SETTING = HOSTILE_FLAG | FLAGS_FLAG | MULTIPLIER_FLAG | PACKET_HOSTILE_FLAG
 
 
+"""Ways of adjusting the max_hp_multiplier of an entity for a
+relation.
+
+"""
+HP_NATIVE = 0
+HP_REDUCE = 1 # NPC displayed as player, reduce to power_health
+HP_EXTEND = 2 # player not displayed as player, extend to 2
+
+
+RELATIONS = range(RELATION_FRIENDLY_PLAYER, RELATION_TARGET + 1)
+
+
+def _build_relation_table():
+    """Builds a table indexed by [native hostile type][hostile type]
+    holding the relation constants of NATIVE_SETTING_MAPPING.
+    
+    """
+    table = [None] * (max(NATIVE_SETTING_MAPPING) + 1)
+    for native_type, settings in NATIVE_SETTING_MAPPING.items():
+        row = [None] * (max(settings) + 1)
+        for hostile_type, relation in settings.items():
+            row[hostile_type] = relation
+        table[native_type] = tuple(row)
+    return tuple(table)
+
+
+def _build_display_table():
+    """Builds a table indexed by [relation - RELATION_FRIENDLY_PLAYER]
+    holding tuples (hostile type, mask extension, hostile).
+    
+    """
+    table = []
+    for relation in RELATIONS:
+        hostile_type = RELATION_HOSTILE_TYPE_MAPPING[relation]
+        if relation > RELATION_FRIENDLY:
+            mask_extension = PACKET_HOSTILE_FLAG
+        else:
+            mask_extension = 0
+        hostile = relation >= RELATION_HOSTILE_PLAYER
+        table.append((hostile_type, mask_extension, hostile))
+    return tuple(table)
+
+
+def _build_hp_table():
+    """Builds a table indexed by [native hostile type][relation -
+    RELATION_FRIENDLY_PLAYER] holding the max_hp_multiplier
+    adjustment to use.
+    
+    """
+    table = [None] * (max(NATIVE_SETTING_MAPPING) + 1)
+    for native_type in NATIVE_SETTING_MAPPING:
+        row = []
+        for relation in RELATIONS:
+            hos_type = RELATION_HOSTILE_TYPE_MAPPING[relation]
+            if hos_type == native_type:
+                row.append(HP_NATIVE)
+            elif native_type != FRIENDLY_PLAYER_TYPE:
+                if hos_type == FRIENDLY_PLAYER_TYPE:
+                    row.append(HP_REDUCE)
+                else:
+                    row.append(HP_NATIVE)
+            elif hos_type != FRIENDLY_PLAYER_TYPE:
+                row.append(HP_EXTEND)
+            else:
+                row.append(HP_NATIVE)
+        table[native_type] = tuple(row)
+    return tuple(table)
+
+
+NATIVE_RELATION_TABLE = _build_relation_table()
+RELATION_DISPLAY_TABLE = _build_display_table()
+HP_ADJUSTMENT_TABLE = _build_hp_table()
+
+
+class RelationRegistry:
+    """Reverse index of custom relations. Records which entities hold
+    a custom relation toward an entity, so only those need to be
+    touched when it is removed.
+    
+    """
+    def __init__(self):
+        """Creates a new RelationRegistry."""
+        self.__holders = {} # target id -> {holder ids}
+
+    def add(self, holder_id, target_id):
+        """Records that an entity holds a relation toward another.
+        
+        Keyword arguments:
+        holder_id -- ID of the entity holding the relation
+        target_id -- ID of the entity the relation is held toward
+        
+        """
+        holders = self.__holders.get(target_id)
+        if holders is None:
+            holders = set()
+            self.__holders[target_id] = holders
+        holders.add(holder_id)
+
+    def discard(self, holder_id, target_id):
+        """Removes a relation record if it exists.
+        
+        Keyword arguments:
+        holder_id -- ID of the entity holding the relation
+        target_id -- ID of the entity the relation is held toward
+        
+        """
+        holders = self.__holders.get(target_id)
+        if holders is not None:
+            holders.discard(holder_id)
+            if not holders:
+                del self.__holders[target_id]
+
+    def pop_holders(self, target_id):
+        """Removes and returns all holders of relations toward an
+        entity.
+        
+        Keyword arguments:
+        target_id -- ID of the entity the relations are held toward
+        
+        Returns:
+        A set of entity ids.
+        
+        """
+        return self.__holders.pop(target_id, ())
+
+
 class EntityExtension:
     """Class representing an extension for the standard entity class."""
 
@@ -171,12 +298,22 @@ class EntityExtension:
         self.__initialized = False
         # Non standard hostilities are saved here in form: <entity id:relation> 
         self.__relation_to = {}
+        # Row of NATIVE_RELATION_TABLE for this entities hostile type
+        self.__native_relations = None
+        # Cached max_hp_multipliers indexed by relation, only valid for
+        # the (power_base, native max_hp_multiplier) in __hp_cache_key
+        self.__hp_multipliers = None
+        self.__hp_cache_key = None
+        # Relations this entity has been sent with, form: <player:relation>
+        self.__viewers = {}
         self.__entity_update_packet = EntityUpdate()
     
     def __init(self):
         """Initializes this entity. Only called if this entity is a player."""
         self._native_hostile_type = self._entity.hostile_type
         self._native_max_hp_multiplier = self._entity.max_hp_multiplier
+        self.__native_relations = NATIVE_RELATION_TABLE[
+            self._native_hostile_type]
         # perform complete update, this is the initial data transfer
         self._entity.mask = FULL_MASK
         
@@ -220,7 +357,7 @@ class EntityExtension:
         One of the hostility types from cuwo.constants
         
         """
-        return RELATION_HOSTILE_TYPE_MAPPING[relation]
+        return RELATION_DISPLAY_TABLE[relation - RELATION_FRIENDLY_PLAYER][0]
         
     def get_mask_extension_by_relation(self, relation):
         """Gets the mask for a specified relation.
@@ -232,14 +369,12 @@ class EntityExtension:
         The flag extension for the specified relation.
         
         """
-        if relation > RELATION_FRIENDLY:
-            return PACKET_HOSTILE_FLAG
-        else:
-            return 0
+        return RELATION_DISPLAY_TABLE[relation - RELATION_FRIENDLY_PLAYER][1]
     
     def get_max_hp_multiplier_by_relation(self, relation):
         """Gets the max_hp_multiplier to use for an entity that shall
-        have the specified relation.
+        have the specified relation. The values are cached until the
+        power_base or the native max_hp_multiplier change.
         
         Keyword arguments:
         relation -- Relation to display.
@@ -250,28 +385,20 @@ class EntityExtension:
         """
         if not self.__initialized:
             return 1
-        else:
-            native_hostile_type = self._native_hostile_type
-            native_max_hp_multiplier = self._native_max_hp_multiplier
-            hos_type = self.get_hostile_type_by_relation(relation)
-            if hos_type == native_hostile_type:
-                return native_max_hp_multiplier
-            elif self.is_npc():
-                if hos_type == FRIENDLY_PLAYER_TYPE:
-                    # NPC and FRIENDlY_PLAYER setting, so it is neccassary to
-                    # adjust the hp multiplier. Reduce it to power_health.
-                    power_health = 2 ** (self._entity.power_base * 0.25)
-                    return (power_health / 2) * native_max_hp_multiplier
-                else:
-                    return native_max_hp_multiplier
-            else:
-                if hos_type != FRIENDLY_PLAYER_TYPE:
-                    # Player and not default setting, so it is neccessary to
-                    # adjust the hp multiplier. Extend it to 2.
-                    power_health = 2 ** (self._entity.power_base * 0.25)
-                    return (2 / power_health) * native_max_hp_multiplier
-                else:
-                    return native_max_hp_multiplier
+        native_max_hp_multiplier = self._native_max_hp_multiplier
+        key = (self._entity.power_base, native_max_hp_multiplier)
+        if key != self.__hp_cache_key:
+            power_health = 2 ** (key[0] * 0.25)
+            multipliers = {
+                HP_NATIVE : native_max_hp_multiplier,
+                HP_REDUCE : (power_health / 2) * native_max_hp_multiplier,
+                HP_EXTEND : (2 / power_health) * native_max_hp_multiplier,
+            }
+            adjustments = HP_ADJUSTMENT_TABLE[self._native_hostile_type]
+            self.__hp_multipliers = tuple(multipliers[adjustment]
+                                          for adjustment in adjustments)
+            self.__hp_cache_key = key
+        return self.__hp_multipliers[relation - RELATION_FRIENDLY_PLAYER]
     
     def get_modified_flags(self, relation, flags):
         """Gets the effective flags for a relation.
@@ -284,7 +411,7 @@ class EntityExtension:
         The modified flags.
         
         """
-        if relation >= RELATION_HOSTILE_PLAYER:
+        if RELATION_DISPLAY_TABLE[relation - RELATION_FRIENDLY_PLAYER][2]:
             # hostile
             return flags | HOSTILE_FLAG
         else:
@@ -303,7 +430,11 @@ class EntityExtension:
             del self.__relation_to[entity._entity.entity_id]
     
     def send(self, players):
-        """Sends this entitys data to the given players.
+        """Sends this entitys data to the given players. Players that
+        did not see this entity in the last update receive a complete
+        update, players that already know the current state of this
+        entity are skipped. Players are grouped by their relation to
+        this entity, so the packet is only serialized once per group.
         
         Keyword arguments:
         players -- A list of players
@@ -312,19 +443,48 @@ class EntityExtension:
         if self.__initialized:
             e = self._entity
             f = e.flags
-            eu = self.__entity_update_packet
+            mask = e.mask
+            old_viewers = self.__viewers
+            viewers = {}
+            groups = {} # (relation, mask) -> [players]
             for player in players:
                 pe = player.entity
-                relation = pe.cubolt_entity.get_relation_to(self._entity)
-                e.hostile_type = self.get_hostile_type_by_relation(relation)
+                relation = pe.cubolt_entity.get_relation_to(e)
+                viewers[player] = relation
+                old_relation = old_viewers.get(player)
+                if old_relation is None:
+                    player_mask = FULL_MASK
+                elif old_relation != relation:
+                    player_mask = mask | MASK_HOSTILITY_SETTING
+                elif mask == 0:
+                    continue
+                else:
+                    player_mask = mask
+                key = (relation, player_mask)
+                if key in groups:
+                    groups[key].append(player)
+                else:
+                    groups[key] = [player]
+            self.__viewers = viewers
 
+            eu = self.__entity_update_packet
+            hostile_flags = f | HOSTILE_FLAG
+            friendly_flags = f & ~HOSTILE_FLAG
+            for (relation, player_mask), group in groups.items():
+                hostile_type, mask_extension, hostile = \
+                    RELATION_DISPLAY_TABLE[relation - RELATION_FRIENDLY_PLAYER]
+                e.hostile_type = hostile_type
                 e.max_hp_multiplier = self.get_max_hp_multiplier_by_relation(
                     relation)
-                e.mask |= self.get_mask_extension_by_relation(relation)
-                e.flags = self.get_modified_flags(relation, e.flags)
-            
-                eu.set_entity(e, e.entity_id, e.mask)
-                player.send_packet(eu)
+                if hostile:
+                    e.flags = hostile_flags
+                else:
+                    e.flags = friendly_flags
+
+                eu.set_entity(e, e.entity_id, player_mask | mask_extension)
+                data = write_packet(eu)
+                for player in group:
+                    player.transport.write(data)
         
             # Reset entity data to defaults, so all other scripts and server
             # algorithms are still working the intended way
@@ -332,6 +492,16 @@ class EntityExtension:
             e.max_hp_multiplier = self._native_max_hp_multiplier
             e.mask = 0
             e.flags = f
+
+    def forget_viewer(self, player):
+        """Forgets that a player has seen this entity, so that the
+        player receives a complete update the next time it is near.
+        
+        Keyword arguments:
+        player -- Player that left the view radius or disconnected
+        
+        """
+        self.__viewers.pop(player, None)
     
     # Following methods are injected into cuwo's default entity.
     # injected
@@ -377,7 +547,10 @@ class EntityExtension:
         own_id = self._entity.entity_id
         if entity_id != own_id:
             self.__relation_to[entity_id] = relation
+            self.__server.relation_registry.add(own_id, entity_id)
             self._entity.mask |= MASK_HOSTILITY_SETTING
+            # the other entity has to be re-sent to this entities player
+            self.__server.changed_entities.add(entity_id)
             self.__server.scripts.call('on_relation_changed',
                 entity_from_id=own_id, entity_to_id=entity_id,
                 relation=relation)
@@ -426,9 +599,8 @@ class EntityExtension:
             return self.__relation_to[entity_id]
         else:
             # determine from standards
-            settings = NATIVE_SETTING_MAPPING[self._native_hostile_type]
             ce = entity.cubolt_entity
-            return settings[ce._native_hostile_type]
+            return self.__native_relations[ce._native_hostile_type]
         
     #injected
     def get_relation_to_id(self, entity_id):
@@ -513,9 +685,22 @@ class EntityExtension:
     # injected
     def destroy(self):
         """Destroys this entity."""
-        del self._entity.world.entities[self._entity.entity_id] 
+        entity_id = self._entity.entity_id
+        world = self._entity.world
+        server = self.__server
+        del world.entities[entity_id] 
         if not self._entity.static_id: 
-            self._entity.world.entity_ids.put_back(self.entity_id) 
-
-        for entity in self._entity.world.entities.values():
-            entity.cubolt_entity._entity_removed(self)
\ No newline at end of file
+            world.entity_ids.put_back(entity_id) 
+        server.entity_grid.remove_entity(entity_id)
+        server.changed_entities.discard(entity_id)
+
+        # only entities holding a relation toward this one need to
+        # forget it
+        registry = server.relation_registry
+        for holder_id in registry.pop_holders(entity_id):
+            holder = world.entities.get(holder_id)
+            if holder is not None:
+                holder.cubolt_entity._entity_removed(self)
+        for target_id in self.__relation_to:
+            registry.discard(entity_id, target_id)
+        self.__relation_to.clear()
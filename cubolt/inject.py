@@ -29,7 +29,10 @@
 
 
 import asyncio
+import os.path
+from concurrent.futures import ThreadPoolExecutor
 
+from cuwo.entity import POS_FLAG
 from cuwo.loop import LoopingCall
 from cuwo.packet import CurrentTime
 from cuwo.packet import UpdateFinished
@@ -38,12 +41,42 @@ from cuwo.vector import Vector2
 from cuwo.vector import Vector3
 
 from .entity import EntityExtension
+from .entity import RelationRegistry
+from .interest import InterestGrid
+from .interest import SubscriptionIndex
+from .network import UpdatePacketEncoder
+from .model import get_model_version
 from .model import CubeModel
+from .model import ModelCache
+from .model import ModelDatabase
 from .particle import ParticleEffect
-from .world import Block
+from .storage import SQLiteOverlayStore
+from .world import intern_block
+from .world import BlockEditTransaction
+from .world import BlockRegion
+from .world import ChunkPrefetcher
+from .world import ChunkUnloader
+from .world import PREFETCH_INTERVAL
+from .world import ProxyCache
+from .world import SAVE_INTERVAL
+from .world import UNLOAD_CHECK_INTERVAL
 from .world import CuBoltChunk
 
 
+OVERLAY_DATABASE = os.path.join('data', 'cubolt', 'edits.db')
+
+
+"""Number of threads loading models in the background."""
+MODEL_LOADER_THREADS = 2
+
+
+"""Name of the entry in cuwo's base.py listing the models in data1.db
+loaded into the model cache on startup.
+
+"""
+WARM_MODELS_CONFIG = 'cubolt_warm_models'
+
+
 class Injector(object):
     """Class holding all methods injected into cuwo."""
     def __init__(self, server):
@@ -59,6 +92,16 @@ class Injector(object):
         """Injects CuBolts update routine into cuwo."""
         self.update_finished_packet = UpdateFinished()
         self.time_packet = CurrentTime()
+        self.server.entity_grid = InterestGrid()
+        self.server.changed_entities = set()
+        self.server.chunk_subscribers = SubscriptionIndex()
+        encoder = UpdatePacketEncoder(self.server.update_packet)
+        if encoder.is_supported():
+            self.update_encoder = encoder
+        else:
+            print('[CB] Unknown update packet layout, update packets ' +
+                  'will be encoded for each client.')
+            self.update_encoder = None
         
         self.server.update = self.update
         self.server.update_loop.func = self.server.update
@@ -70,11 +113,40 @@ class Injector(object):
         s.scripts.call('update')
         
         # entity updates
+        # Only entities that changed since the last update are sent.
+        # Changed entities are those with a non-empty mask, those
+        # whose relations changed and those a player has just come
+        # close to.
+        grid = s.entity_grid
+        changed = s.changed_entities
+        players = s.players
+        entities = s.world.entities
+        for entity_id, entity in entities.items():
+            mask = entity.mask
+            if mask or entity_id not in grid:
+                changed.add(entity_id)
+                old_cell = grid.get_cell(entity_id)
+                if (mask & POS_FLAG or old_cell is None) and \
+                    grid.update_entity(entity) and entity_id in players:
+                    cell = grid.get_cell(entity_id)
+                    for near in grid.get_entities_near(cell):
+                        changed.add(near.entity_id)
+                    # entities out of sight have to send a complete
+                    # update when the player comes back
+                    if old_cell is not None:
+                        player = players[entity_id]
+                        for left in grid.get_entities_left(old_cell, cell):
+                            left.cubolt_entity.forget_viewer(player)
+        player_cells = grid.get_player_cells(players.values())
+
         # The client doesn't allow friendly display and hostile
         # behaviour, so have a little workaround...
-        players = s.players.values()
-        for entity in s.world.entities.values():
-            entity.cubolt_entity.send(players)
+        for entity_id in changed:
+            entity = entities.get(entity_id)
+            if entity is not None:
+                viewers = grid.get_viewers(entity_id, player_cells)
+                entity.cubolt_entity.send(viewers)
+        changed.clear()
         s.broadcast_packet(self.update_finished_packet)
 
         # Update particle effects
@@ -89,9 +161,13 @@ class Injector(object):
         # Send the update packet for this frame. For performance
         # reasons the packets are different for each client
         # (regarding particles and block updates).
+        # The shared sections are encoded only once.
+        encoder = self.update_encoder
+        if encoder is not None:
+            encoder.encode_shared(update_packet)
         cubolt = s.scripts.cubolt
         for connection in cubolt.children:
-            connection.send_update_packet(update_packet)
+            connection.send_update_packet(update_packet, encoder)
 
         update_packet.reset()
 
@@ -108,7 +184,9 @@ class Injector(object):
         
     def inject_entity(self):
         """Injects entity specific methods."""
+        self.server.relation_registry = RelationRegistry()
         self.server.world.create_entity = self.create_entity
+        self.server.world.destroy_many = self.destroy_many
         
     def create_entity(self, entity_id=None):
         """Creates a new entity.
@@ -122,6 +200,19 @@ class Injector(object):
         self.inject_into_entity(e)
         return e
         
+    def destroy_many(self, entity_ids):
+        """Destroys multiple entities.
+        
+        Keyword arguments:
+        entity_ids -- IDs of the entities to destroy
+        
+        """
+        entities = self.server.world.entities
+        for entity_id in entity_ids:
+            entity = entities.get(entity_id)
+            if entity is not None:
+                entity.destroy()
+        
     def inject_into_entity(self, entity):
         """Injects all entity specific methods into the entity.
         
@@ -145,9 +236,52 @@ class Injector(object):
         s = self.server
         w = s.world
         w.server = s
+        s.proxy_cache = ProxyCache()
+        s.overlay_store = SQLiteOverlayStore(OVERLAY_DATABASE)
+        s.edited_chunks = {}
         w.chunk_class = CuBoltChunk
         w.get_block = self.get_block
+        w.get_blocks = self.get_blocks
+        w.get_height = self.get_height
         w.set_block = self.set_block
+        w.set_blocks = self.set_blocks
+        w.edit = self.edit
+
+        self.chunk_unloader = ChunkUnloader(s)
+        self.unload_loop = LoopingCall(self.chunk_unloader.update)
+        self.unload_loop.start(UNLOAD_CHECK_INTERVAL)
+        self.save_loop = LoopingCall(self.save_edits)
+        self.save_loop.start(SAVE_INTERVAL)
+        self.chunk_prefetcher = ChunkPrefetcher(s)
+        self.prefetch_loop = LoopingCall(self.chunk_prefetcher.update)
+        # without tgen chunks never receive data, nothing to prefetch
+        if w.use_tgen:
+            self.prefetch_loop.start(PREFETCH_INTERVAL)
+
+    def save_edits(self):
+        """Saves the edits of all chunks edited since the last call in
+        the background.
+
+        """
+        s = self.server
+        store = s.overlay_store
+        edited_chunks = s.edited_chunks
+        for pos, chunk in edited_chunks.items():
+            store.save(pos, chunk._get_overlay_data())
+        edited_chunks.clear()
+        store.flush()
+
+    def close(self):
+        """Stops the background work and saves all pending edits."""
+        for loop in (self.unload_loop, self.save_loop, self.prefetch_loop):
+            if loop.running:
+                loop.stop()
+        self.save_edits()
+        # chunks loaded or unloaded later find no store instead of a
+        # closed one
+        self.server.overlay_store.close()
+        self.server.overlay_store = None
+        self.server.cubolt_factory.close()
 
     def get_block(self, position):
         """Gets a block.
@@ -167,6 +301,65 @@ class Injector(object):
         y = position.y - chunk_y * 256
         return chunk.get_block(Vector3(x, y, position.z))
 
+    def get_height(self, x, y):
+        """Gets the height of the world at a position.
+        
+        Keyword arguments:
+        x -- Absolute x coordinate in block coordinates.
+        y -- Absolute y coordinate in block coordinates.
+
+        Returns:
+        The z coordinate of the first block above the ground or None
+        if the chunk isn't loaded yet.
+
+        """
+        x = int(x)
+        y = int(y)
+        chunk_x = x // 256
+        chunk_y = y // 256
+        chunk = self.server.world.get_chunk(Vector2(chunk_x, chunk_y))
+        data = chunk.data
+        if data is None:
+            return None
+        return data.get_height(x - chunk_x * 256, y - chunk_y * 256)
+
+    def get_blocks(self, min_pos, max_pos):
+        """Reads all blocks within a box. The box is split by chunk and
+        each column is read at once.
+        
+        Keyword arguments:
+        min_pos -- Lowest absolute position in block coordinates
+            (inclusive).
+        max_pos -- Highest absolute position in block coordinates
+            (exclusive).
+
+        Returns:
+        A BlockRegion.
+
+        """
+        x0 = int(min_pos.x)
+        y0 = int(min_pos.y)
+        z0 = int(min_pos.z)
+        x1 = int(max_pos.x)
+        y1 = int(max_pos.y)
+        z1 = int(max_pos.z)
+        region = BlockRegion(x0, y0, z0, max(x1 - x0, 0), max(y1 - y0, 0),
+                             max(z1 - z0, 0))
+        if not (x0 < x1 and y0 < y1 and z0 < z1):
+            return region
+
+        w = self.server.world
+        for chunk_x in range(x0 // 256, (x1 - 1) // 256 + 1):
+            for chunk_y in range(y0 // 256, (y1 - 1) // 256 + 1):
+                chunk = w.get_chunk(Vector2(chunk_x, chunk_y))
+                read = chunk._read_region(
+                    region,
+                    max(x0, chunk_x * 256), min(x1, (chunk_x + 1) * 256),
+                    max(y0, chunk_y * 256), min(y1, (chunk_y + 1) * 256))
+                if not read:
+                    region.missing_chunks.append((chunk_x, chunk_y))
+        return region
+
     def set_block(self, position, block):
         """Sets a block.
         
@@ -182,10 +375,52 @@ class Injector(object):
         x = position.x - chunk_x * 256
         y = position.y - chunk_y * 256
         chunk.set_block(Vector3(x, y, position.z), block)
+
+    def set_blocks(self, blocks):
+        """Sets multiple blocks at once. The blocks are grouped by
+        chunk, so each chunk invalidates its clients only once.
+        
+        Keyword arguments:
+        blocks -- Iterable of ((x, y, z), block) tuples with absolute
+            positions in block coordinates.
+        
+        """
+        chunks = {} # (chunk x, chunk y) -> [((x, y, z), block)]
+        for (x, y, z), block in blocks:
+            x = int(x)
+            y = int(y)
+            chunk_x = x // 256
+            chunk_y = y // 256
+            key = (chunk_x, chunk_y)
+            local = ((x - chunk_x * 256, y - chunk_y * 256, int(z)), block)
+            if key in chunks:
+                chunks[key].append(local)
+            else:
+                chunks[key] = [local]
+
+        w = self.server.world
+        for (chunk_x, chunk_y), chunk_blocks in chunks.items():
+            chunk = w.get_chunk(Vector2(chunk_x, chunk_y))
+            chunk.set_blocks(chunk_blocks)
+
+    def edit(self):
+        """Starts a block edit transaction.
+        
+        Returns:
+        A BlockEditTransaction, its edits are applied at once when it
+        is committed.
+
+        """
+        return BlockEditTransaction(self.server.world)
         
     def inject_factory(self):
         """Injects CuBolts factory into the server."""
+        self.server.model_database = ModelDatabase()
         self.server.cubolt_factory = CuBoltFactory(self.server)
+        warm_models = getattr(self.server.config.base, WARM_MODELS_CONFIG,
+                              None)
+        if warm_models:
+            self.server.cubolt_factory.load_models(warm_models)
      
         
 class CuBoltFactory:
@@ -198,6 +433,11 @@ class CuBoltFactory:
         
         """
         self.server = server
+        self.__model_loader = ThreadPoolExecutor(
+            max_workers=MODEL_LOADER_THREADS)
+        self.model_cache = ModelCache()
+        self.__loading_models = {} # (from database, name) -> future
+        self.closed = False
 
     def create_particle_effect(self, data=None):
         """Creates a particle effect."""
@@ -212,9 +452,101 @@ class CuBoltFactory:
             name of the file in the databse must be given, False to 
             load a .cub file, in this case a relative path needs to be
             given
+
+        Returns:
+        The model, it can be transformed without affecting other loaded
+        instances of the same model.
+        
+        """
+        key = (from_database, filename)
+        version = get_model_version(filename, from_database)
+        model = self.model_cache.get(key, version)
+        if model is None:
+            model = CubeModel(self.server, filename, from_database)
+            self.model_cache.put(key, version, model)
+        return model.copy()
+
+    def load_models(self, names):
+        """Loads multiple models from data1.db, the models which aren't
+        cached are read with a single query.
+        
+        Keyword arguments:
+        names -- Names of the models in the database
+
+        Returns:
+        A dict mapping the names of the found models to the models.
+        
+        """
+        version = get_model_version(None, True)
+        models = {}
+        missing = []
+        for name in names:
+            model = self.model_cache.get((True, name), version)
+            if model is None:
+                missing.append(name)
+            else:
+                models[name] = model
+        if missing:
+            blobs = self.server.model_database.load_blobs(missing)
+            for name, blob in blobs.items():
+                model = CubeModel(self.server, name, True, blob)
+                self.model_cache.put((True, name), version, model)
+                models[name] = model
+        return {name : model.copy() for name, model in models.items()}
+
+    def load_model_async(self, filename, from_database=False):
+        """Loads a .cub model in a background thread, so that the
+        server keeps running while large models are read, descrambled
+        and parsed.
+        
+        Keyword arguments:
+        filename -- Name or path of the file to load
+        from_datbase -- True, to load from data1.db, in this case the
+            name of the file in the databse must be given, False to 
+            load a .cub file, in this case a relative path needs to be
+            given
+
+        Returns:
+        An asyncio future resolving to the model.
         
         """
-        return CubeModel(self.server, filename, from_database)
+        # the executor doesn't accept work after close
+        if self.closed:
+            raise RuntimeError('The model loader has been closed')
+        return asyncio.ensure_future(
+            self.__load_model_async(filename, from_database),
+            loop=self.server.loop)
+
+    async def __load_model_async(self, filename, from_database):
+        key = (from_database, filename)
+        version = get_model_version(filename, from_database)
+        model = self.model_cache.get(key, version)
+        if model is None:
+            # models requested again while loading are only loaded once
+            future = self.__loading_models.get(key)
+            if future is None:
+                future = self.server.loop.run_in_executor(
+                    self.__model_loader, CubeModel, self.server, filename,
+                    from_database)
+                self.__loading_models[key] = future
+                try:
+                    model = await future
+                finally:
+                    del self.__loading_models[key]
+                self.model_cache.put(key, version, model)
+            else:
+                model = await future
+        return model.copy()
+
+    def close(self):
+        """Stops the background model loading, empties the model cache
+        and closes data1.db.
+
+        """
+        self.closed = True
+        self.__model_loader.shutdown(wait=False)
+        self.model_cache.clear()
+        self.server.model_database.close()
 
     def create_block(self, color=(0,0,0), type=EMPTY_TYPE, breakable=False):
-        return Block(color, type, breakable)
\ No newline at end of file
+        return intern_block(color, type, breakable)
\ No newline at end of file
@@ -0,0 +1,308 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 Bjoern Lange
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# This file is part of CuBolt.
+
+
+"""Spatial interest management."""
+
+
+from cuwo.constants import BLOCK_SCALE
+
+
+"""Default radius (in chunks) in which players receive entity
+updates.
+
+"""
+DEFAULT_VIEW_RADIUS = 2
+
+
+"""Radius (in chunks) around a player in which block edits and particles
+are sent to it.
+
+"""
+SUBSCRIPTION_RADIUS = 2
+
+
+CHUNK_SCALE = BLOCK_SCALE * 256
+
+
+def get_chunk_pos(pos):
+    """Gets the chunk coordinates of a position.
+
+    Keyword arguments:
+    pos -- Position in world coordinates.
+
+    Returns:
+    Tuple (chunk x, chunk y).
+
+    """
+    return (int(pos.x / CHUNK_SCALE), int(pos.y / CHUNK_SCALE))
+
+
+class InterestGrid:
+    """Chunk bucketed spatial index of entities."""
+    def __init__(self, radius=DEFAULT_VIEW_RADIUS):
+        """Creates a new InterestGrid.
+
+        Keyword arguments:
+        radius -- Radius in chunks in which entities are visible
+
+        """
+        self.radius = radius
+        self.__cells = {} # (chunk x, chunk y) -> {entity id: entity}
+        self.__entity_cells = {} # entity id -> (chunk x, chunk y)
+
+    def __contains__(self, entity_id):
+        return entity_id in self.__entity_cells
+
+    def get_cell(self, entity_id):
+        """Gets the cell an entity is currently registered in.
+
+        Keyword arguments:
+        entity_id -- ID of the entity
+
+        Returns:
+        Tuple (chunk x, chunk y) or None if the entity is unknown.
+
+        """
+        return self.__entity_cells.get(entity_id)
+
+    def update_entity(self, entity):
+        """Updates the cell of an entity from its current position.
+
+        Keyword arguments:
+        entity -- cuwo entity to update
+
+        Returns:
+        True if the entity has changed its cell, otherwise False.
+
+        """
+        entity_id = entity.entity_id
+        cell = get_chunk_pos(entity.pos)
+        old_cell = self.__entity_cells.get(entity_id)
+        if old_cell == cell:
+            return False
+        if old_cell is not None:
+            self.__remove_from_cell(entity_id, old_cell)
+        self.__entity_cells[entity_id] = cell
+        bucket = self.__cells.get(cell)
+        if bucket is None:
+            bucket = {}
+            self.__cells[cell] = bucket
+        bucket[entity_id] = entity
+        return True
+
+    def remove_entity(self, entity_id):
+        """Removes an entity from the grid.
+
+        Keyword arguments:
+        entity_id -- ID of the entity to remove
+
+        """
+        cell = self.__entity_cells.pop(entity_id, None)
+        if cell is not None:
+            self.__remove_from_cell(entity_id, cell)
+
+    def __remove_from_cell(self, entity_id, cell):
+        bucket = self.__cells[cell]
+        del bucket[entity_id]
+        if not bucket:
+            del self.__cells[cell]
+
+    def get_entities_near(self, cell):
+        """Gets all entities within the view radius of a cell.
+
+        Keyword arguments:
+        cell -- Tuple (chunk x, chunk y)
+
+        Returns:
+        A generator yielding the entities.
+
+        """
+        cells = self.__cells
+        r = self.radius
+        cx, cy = cell
+        for x in range(cx - r, cx + r + 1):
+            for y in range(cy - r, cy + r + 1):
+                bucket = cells.get((x, y))
+                if bucket is not None:
+                    yield from bucket.values()
+
+    def get_entities_left(self, old_cell, new_cell):
+        """Gets the entities a player no longer sees after moving from
+        one cell to another.
+
+        Keyword arguments:
+        old_cell -- Tuple (chunk x, chunk y) the player was in
+        new_cell -- Tuple (chunk x, chunk y) the player is in now
+
+        Returns:
+        A generator yielding the entities.
+
+        """
+        r = self.radius
+        nx, ny = new_cell
+        cells = self.__cells
+        cx, cy = old_cell
+        for x in range(cx - r, cx + r + 1):
+            for y in range(cy - r, cy + r + 1):
+                if abs(x - nx) <= r and abs(y - ny) <= r:
+                    continue
+                bucket = cells.get((x, y))
+                if bucket is not None:
+                    yield from bucket.values()
+
+    def get_player_cells(self, players):
+        """Buckets player connections by the cell they are in.
+
+        Keyword arguments:
+        players -- Player connections
+
+        Returns:
+        A dict mapping cells to lists of player connections.
+
+        """
+        player_cells = {}
+        for player in players:
+            pe = player.entity
+            cell = self.__entity_cells.get(pe.entity_id)
+            if cell is None:
+                cell = get_chunk_pos(pe.pos)
+            if cell in player_cells:
+                player_cells[cell].append(player)
+            else:
+                player_cells[cell] = [player]
+        return player_cells
+
+    def get_viewers(self, entity_id, player_cells):
+        """Gets the players that are able to see an entity.
+
+        Keyword arguments:
+        entity_id -- ID of the entity
+        player_cells -- Player buckets as returned by get_player_cells
+
+        Returns:
+        A list of player connections.
+
+        """
+        viewers = []
+        cell = self.__entity_cells.get(entity_id)
+        if cell is None:
+            return viewers
+        r = self.radius
+        cx, cy = cell
+        for x in range(cx - r, cx + r + 1):
+            for y in range(cy - r, cy + r + 1):
+                players = player_cells.get((x, y))
+                if players is not None:
+                    viewers.extend(players)
+        return viewers
+
+
+class SubscriptionIndex:
+    """Maps chunks to the connection scripts interested in them."""
+    def __init__(self, radius=SUBSCRIPTION_RADIUS):
+        """Creates a new SubscriptionIndex.
+
+        Keyword arguments:
+        radius -- Radius in chunks around a connection's chunk it is
+            subscribed to
+
+        """
+        self.radius = radius
+        self.__subscribers = {} # (chunk x, chunk y) -> {connection script}
+        self.__cells = {} # connection script -> (chunk x, chunk y)
+
+    def get_cell(self, script):
+        """Gets the chunk a connection script is subscribed around.
+
+        Keyword arguments:
+        script -- Connection script
+
+        Returns:
+        Tuple (chunk x, chunk y) or None if it isn't subscribed.
+
+        """
+        return self.__cells.get(script)
+
+    def subscribe(self, script, cell):
+        """Subscribes a connection script to the chunks around a chunk
+        and removes its previous subscriptions.
+
+        Keyword arguments:
+        script -- Connection script
+        cell -- Tuple (chunk x, chunk y)
+
+        """
+        if self.__cells.get(script) == cell:
+            return
+        self.unsubscribe(script)
+        self.__cells[script] = cell
+        subscribers = self.__subscribers
+        r = self.radius
+        cx, cy = cell
+        for x in range(cx - r, cx + r + 1):
+            for y in range(cy - r, cy + r + 1):
+                scripts = subscribers.get((x, y))
+                if scripts is None:
+                    subscribers[(x, y)] = {script}
+                else:
+                    scripts.add(script)
+
+    def unsubscribe(self, script):
+        """Removes all subscriptions of a connection script.
+
+        Keyword arguments:
+        script -- Connection script
+
+        """
+        cell = self.__cells.pop(script, None)
+        if cell is None:
+            return
+        subscribers = self.__subscribers
+        r = self.radius
+        cx, cy = cell
+        for x in range(cx - r, cx + r + 1):
+            for y in range(cy - r, cy + r + 1):
+                scripts = subscribers[(x, y)]
+                scripts.discard(script)
+                if not scripts:
+                    del subscribers[(x, y)]
+
+    def get_subscribers(self, x, y):
+        """Gets the connection scripts subscribed to a chunk.
+
+        Keyword arguments:
+        x -- Chunk x coordinate
+        y -- Chunk y coordinate
+
+        Returns:
+        A set of connection scripts, it must not be modified.
+
+        """
+        return self.__subscribers.get((x, y), EMPTY_SUBSCRIBERS)
+
+
+EMPTY_SUBSCRIBERS = frozenset()
@@ -28,9 +28,15 @@
 """Model handling."""
 
 
+import copy
 import sqlite3
 import os.path
 import struct
+import threading
+from urllib.request import pathname2url
+from array import array
+from collections import OrderedDict
+from functools import lru_cache
 
 from cuwo.bytes import ByteReader
 from cuwo.cub import CubModel
@@ -44,6 +50,12 @@ except ImportError:
     MOUNTAIN_TYPE = 6
     block_types_available = False
 
+try:
+    import numpy
+    numpy_available = True
+except ImportError:
+    numpy_available = False
+
 from .world import Block
     
 
@@ -59,6 +71,77 @@ OFFSET_LOOKUP_TABLE = [0x1092, 0x254F, 0x348, 0x14B40, 0x241A, 0x2676,
                        0x72F, 0x0BA8, 0x7C9, 0x0BA8, 0x131F, 0x0C75C7,
                        0x0D]
 
+
+"""Approximate memory (in bytes) of the model cache."""
+MODEL_CACHE_MEMORY = 128 * 1024 * 1024
+
+
+"""Approximate size (in bytes) of a block of a model. With numpy a block
+takes 12 bytes for its position and 3 bytes for its color, otherwise
+it is stored as two tuples in lists.
+
+"""
+MODEL_BLOCK_SIZE = 15 if numpy_available else 250
+
+
+"""Default number of blocks kept in the model cache."""
+DEFAULT_MODEL_CACHE_BLOCKS = MODEL_CACHE_MEMORY // MODEL_BLOCK_SIZE
+
+
+"""Maximum number of models read by a single query."""
+MAX_QUERY_PARAMETERS = 500
+
+
+"""Number of descramble permutations kept, one per blob length."""
+PERMUTATION_CACHE_SIZE = 16
+
+
+# maps each byte to its inverse
+INVERT_TABLE = bytes(255 - i for i in range(256))
+
+
+@lru_cache(maxsize=PERMUTATION_CACHE_SIZE)
+def get_descramble_permutation(data_len):
+    """Computes the order in which the bytes of a scrambled blob are
+    read. Swapping the bytes one after another as Cube World does
+    moves the byte at permutation[i] to i.
+    
+    Keyword arguments:
+    data_len -- Length of the blob.
+
+    Returns:
+    A numpy array if numpy is available, otherwise an array('I').
+
+    """
+    permutation = list(range(data_len))
+    for i in range(data_len - 1, -1, -1):
+        offset = (i + OFFSET_LOOKUP_TABLE[i % 44]) % data_len
+        permutation[i], permutation[offset] = (permutation[offset],
+                                               permutation[i])
+    if numpy_available:
+        return numpy.array(permutation, numpy.intp)
+    return array('I', permutation)
+
+
+def descramble(model_data):
+    """Descrambles a blob from data1.db.
+    
+    Keyword arguments:
+    model_data -- Scrambled bytes.
+
+    Returns:
+    The descrambled bytes.
+
+    """
+    if not model_data:
+        return b''
+    permutation = get_descramble_permutation(len(model_data))
+    if numpy_available:
+        data = numpy.frombuffer(model_data, numpy.uint8)
+        return numpy.invert(data[permutation]).tobytes()
+    data = bytes(model_data)
+    return bytes(data[i] for i in permutation).translate(INVERT_TABLE)
+
     
 class ByteArrayReader:
     def __init__(self, data):
@@ -82,7 +165,11 @@ class ByteArrayReader:
     
 
 class Model:
-    """Base class for all loadable models."""
+    """Base class for all loadable models. The blocks are stored as an
+    array of positions and an array of colors, all transformations
+    create new arrays, so copies of a model can share them.
+
+    """
     def __init__(self, server):
         """Creates a new model.
         
@@ -91,6 +178,93 @@ class Model:
 
         """
         self.server = server
+        self.size = Vector3(0, 0, 0)
+        self.__positions = _empty_positions()
+        self.__colors = _empty_colors()
+        # dict view handed out by the data property, it may have been
+        # modified, so it replaces the arrays on the next access
+        self.__data = None
+
+    def __len__(self):
+        self.__sync()
+        return len(self.__positions)
+
+    @property
+    def data(self):
+        """Dict mapping (x, y, z) tuples to (red, green, blue) tuples.
+        Changes to the dict are applied to the model.
+
+        """
+        if self.__data is None:
+            self.__data = dict(zip(_to_tuples(self.__positions),
+                                   _to_tuples(self.__colors)))
+        return self.__data
+
+    @data.setter
+    def data(self, data):
+        self.__data = None
+        self.__set_blocks(list(data.keys()), list(data.values()))
+
+    def __set_blocks(self, positions, colors):
+        """Replaces the blocks of this model.
+
+        Keyword arguments:
+        positions -- Sequence of (x, y, z) tuples.
+        colors -- Sequence of (red, green, blue) tuples.
+
+        """
+        if numpy_available:
+            if positions:
+                self.__positions = numpy.array(positions, numpy.int32)
+                self.__colors = numpy.array(colors, numpy.uint8)
+            else:
+                self.__positions = _empty_positions()
+                self.__colors = _empty_colors()
+        else:
+            self.__positions = [tuple(pos) for pos in positions]
+            self.__colors = [tuple(color) for color in colors]
+
+    def __sync(self):
+        """Applies changes made to the dict view to the arrays."""
+        if self.__data is not None:
+            data = self.__data
+            self.__data = None
+            self.__set_blocks(list(data.keys()), list(data.values()))
+
+    def get_arrays(self):
+        """Gets the blocks of this model as arrays. The arrays must not
+        be modified.
+
+        Returns:
+        Tuple (positions, colors). With numpy these are arrays of shape
+        (n, 3), otherwise lists of tuples.
+
+        """
+        self.__sync()
+        return (self.__positions, self.__colors)
+
+    def copy(self):
+        """Creates a copy of this model. The copy shares the block
+        arrays with this model, which is safe as all transformations
+        replace them instead of modifying them. Shared numpy arrays are
+        made read only.
+
+        Returns:
+        The copy.
+
+        """
+        self.__sync()
+        if numpy_available:
+            self.__positions.setflags(write=False)
+            self.__colors.setflags(write=False)
+        model = copy.copy(self)
+        if not numpy_available:
+            # the lists could be modified in place
+            model.__positions = list(self.__positions)
+            model.__colors = list(self.__colors)
+        size = self.size
+        model.size = Vector3(size.x, size.y, size.z)
+        return model
 
     def place_in_world_v(self, lower_pos, type=MOUNTAIN_TYPE, breakable=False,
                          remove_blocks=False):
@@ -122,100 +296,181 @@ class Model:
             bounds that are not part of it.
 
         """
-        w = self.server.world
+        self.__sync()
+        positions = _to_tuples(self.__positions)
+        colors = _to_tuples(self.__colors)
+        blocks = []
         if remove_blocks:
-            size = self.size
-            size_x = int(size.x)
-            size_y = int(size.y)
-            size_z = int(size.z)
+            size_x = int(self.size.x)
+            size_y = int(self.size.y)
+            size_z = int(self.size.z)
+            occupied = set(positions)
+            empty = Block()
             for x in range(0, size_x):
                 for y in range(0, size_y):
                     for z in range(0, size_z):
-                        pos = (x,y,z)
-                        pos_v = Vector3(x, y, z)
-                        if pos in self.data:
-                            c = self.data[pos]
-                            w.set_block(pos_v, Block(c,type))
-                        else:
-                            w.set_block(pos_v, Block())
+                        if (x, y, z) not in occupied:
+                            abs_pos = (x + lower_x, y + lower_y, z + lower_z)
+                            blocks.append((abs_pos, empty))
+        for (x, y, z), color in zip(positions, colors):
+            abs_pos = (x + lower_x, y + lower_y, z + lower_z)
+            blocks.append((abs_pos, Block(color, type, breakable)))
+        self.server.world.set_blocks(blocks)
+
+    def transform(self, matrix):
+        """Applies a rotation or mirroring by multiples of 90 degrees.
+        The model is moved afterwards so that all coordinates start at
+        0 again.
+
+        Keyword arguments:
+        matrix -- 3x3 matrix given as rows, each row and each column
+            must hold exactly one entry of 1 or -1.
+
+        """
+        self.__sync()
+        matrix = tuple(tuple(int(v) for v in row) for row in matrix)
+        size = (int(self.size.x), int(self.size.y), int(self.size.z))
+        new_size = []
+        offset = []
+        for row in matrix:
+            new_size.append(sum(abs(v) * size[j] for j, v in enumerate(row)))
+            offset.append(sum(min(0, v * (size[j] - 1))
+                              for j, v in enumerate(row)))
+        if numpy_available:
+            m = numpy.array(matrix, numpy.int32)
+            self.__positions = (self.__positions.dot(m.T) -
+                                numpy.array(offset, numpy.int32))
         else:
-            for pos in self.data.keys():
-                x = pos[0] + lower_x
-                y = pos[1] + lower_y
-                z = pos[2] + lower_z
-                color = self.data[pos]
-                w.set_block(Vector3(x, y, z), Block(color,type))
+            (a, b, c), (d, e, f), (g, h, i) = matrix
+            ox, oy, oz = offset
+            self.__positions = [(a * x + b * y + c * z - ox,
+                                 d * x + e * y + f * z - oy,
+                                 g * x + h * y + i * z - oz)
+                                for x, y, z in self.__positions]
+        self.size = Vector3(*new_size)
+
+    def translate(self, x, y, z):
+        """Moves all blocks of the model. The size is enlarged so that
+        all moved blocks fit, blocks moved below 0 are removed.
+
+        Keyword arguments:
+        x -- Offset on the x-axis.
+        y -- Offset on the y-axis.
+        z -- Offset on the z-axis.
+
+        """
+        self.__sync()
+        x, y, z = int(x), int(y), int(z)
+        size = self.size
+        self.size = Vector3(max(int(size.x) + x, 0), max(int(size.y) + y, 0),
+                            max(int(size.z) + z, 0))
+        if numpy_available:
+            positions = self.__positions + numpy.array((x, y, z),
+                                                       numpy.int32)
+            keep = (positions >= 0).all(axis=1)
+            self.__positions = positions[keep]
+            self.__colors = self.__colors[keep]
+        else:
+            blocks = [((px + x, py + y, pz + z), color)
+                      for (px, py, pz), color in zip(self.__positions,
+                                                     self.__colors)
+                      if px + x >= 0 and py + y >= 0 and pz + z >= 0]
+            self.__positions = [pos for pos, color in blocks]
+            self.__colors = [color for pos, color in blocks]
+
+    def crop(self, min_x, min_y, min_z, max_x, max_y, max_z):
+        """Cuts out a part of the model, it becomes the whole model.
+
+        Keyword arguments:
+        min_x -- First x coordinate to keep.
+        min_y -- First y coordinate to keep.
+        min_z -- First z coordinate to keep.
+        max_x -- X coordinate to stop at (exclusive).
+        max_y -- Y coordinate to stop at (exclusive).
+        max_z -- Z coordinate to stop at (exclusive).
+
+        """
+        self.__sync()
+        lower = (int(min_x), int(min_y), int(min_z))
+        upper = (int(max_x), int(max_y), int(max_z))
+        if numpy_available:
+            positions = self.__positions
+            keep = ((positions >= numpy.array(lower, numpy.int32)) &
+                    (positions < numpy.array(upper, numpy.int32))).all(axis=1)
+            self.__positions = (positions[keep] -
+                                numpy.array(lower, numpy.int32))
+            self.__colors = self.__colors[keep]
+        else:
+            x0, y0, z0 = lower
+            x1, y1, z1 = upper
+            blocks = [((x - x0, y - y0, z - z0), color)
+                      for (x, y, z), color in zip(self.__positions,
+                                                  self.__colors)
+                      if x0 <= x < x1 and y0 <= y < y1 and z0 <= z < z1]
+            self.__positions = [pos for pos, color in blocks]
+            self.__colors = [color for pos, color in blocks]
+        self.size = Vector3(*(max(u - l, 0) for l, u in zip(lower, upper)))
  
     def rotate_left_z(self):
         """Rotates the model for 90 degrees to the left around the
         z-axis.
         
         """
-        new_data = {}
-        max_index_y = int(self.size.y) - 1
-        for pos in self.data.keys():
-            new_pos = (max_index_y - pos[1], pos[0], pos[2])
-            new_data[new_pos]  = self.data[pos]
-        self.data = new_data
-        tmp = self.size.x
-        self.size.x = self.size.y
-        self.size.y = tmp
+        self.transform(ROTATE_LEFT_Z)
 
     def rotate_right_z(self):
         """Rotates the model for 90 degrees to the right around the
         z-axis.
         
         """
-        new_data = {}
-        max_index_x = int(self.size.x) - 1
-        for pos in self.data.keys():
-            new_pos = (pos[1], max_index_x - pos[0], pos[2])
-            new_data[new_pos]  = self.data[pos]
-        self.data = new_data
-        tmp = self.size.x
-        self.size.x = self.size.y
-        self.size.y = tmp
+        self.transform(ROTATE_RIGHT_Z)
 
     def rotate_180_z(self):
         """Rotates the model for 180 degrees to the right around the
         z-axis.
         
         """
-        new_data = {}
-        max_index_x = int(self.size.x) - 1
-        max_index_y = int(self.size.y) - 1
-        for pos in self.data.keys():
-            x = max_index_x - pos[0]
-            y = max_index_y - pos[1]
-            new_pos = (x, y, pos[2])
-            new_data[new_pos]  = self.data[pos]
-        self.data = new_data
+        self.transform(ROTATE_180_Z)
 
     def mirror_x(self):
         """Mirrors the model at the x-axis."""
-        new_data = {}
-        max_index_y = int(self.size.y) - 1
-        for pos in self.data.keys():
-            new_pos = (pos[0], max_index_y - pos[1], pos[2])
-            new_data[new_pos]  = self.data[pos]
-        self.data = new_data
+        self.transform(MIRROR_X)
 
     def mirror_y(self):
         """Mirrors the model at the y-axis."""
-        new_data = {}
-        max_index_x = self.size.x - 1
-        for pos in self.data.keys():
-            new_pos = (max_index_x - pos[0], pos[1], pos[2])
-            new_data[new_pos]  = self.data[pos]
-        self.data = new_data
-        tmp = self.size.x
-        self.size.x = self.size.y
-        self.size.y = tmp
+        self.transform(MIRROR_Y)
+
+
+"""Transformation matrices of the predefined model transformations."""
+ROTATE_LEFT_Z = ((0, -1, 0), (1, 0, 0), (0, 0, 1))
+ROTATE_RIGHT_Z = ((0, 1, 0), (-1, 0, 0), (0, 0, 1))
+ROTATE_180_Z = ((-1, 0, 0), (0, -1, 0), (0, 0, 1))
+MIRROR_X = ((1, 0, 0), (0, -1, 0), (0, 0, 1))
+MIRROR_Y = ((-1, 0, 0), (0, 1, 0), (0, 0, 1))
+
+
+def _empty_positions():
+    if numpy_available:
+        return numpy.empty((0, 3), numpy.int32)
+    return []
+
+
+def _empty_colors():
+    if numpy_available:
+        return numpy.empty((0, 3), numpy.uint8)
+    return []
+
+
+def _to_tuples(values):
+    """Converts a block array to a list of tuples."""
+    if numpy_available:
+        return [tuple(value) for value in values.tolist()]
+    return values
 
  
 class CubeModel(Model):
     """Model class for Cube Worlds default Models (*.cub files)."""
-    def __init__(self, server, filename, from_database=False):
+    def __init__(self, server, filename, from_database=False, blob=None):
         """Creates a new model.
         
         Keyword arguments:
@@ -223,17 +478,18 @@ class CubeModel(Model):
         filename -- Name of the file to load.
         from_database -- True, to load from the default data1.db file,
             False to load the file from disk.
+        blob -- Scrambled blob of the model if it has already been read
+            from data1.db.
 
         """
         Model.__init__(self, server)
         if from_database:
-            db_connection = sqlite3.connect(MODEL_DATABASE)
-            cursor = db_connection.cursor()
-            cursor.execute('SELECT * FROM blobs WHERE key=?',
-                [filename])
-            row = cursor.fetchone()
-            model_data = bytearray(row[1])
-            model_data = self.__descramble(model_data)
+            if blob is None:
+                blob = server.model_database.load_blob(filename)
+                if blob is None:
+                    raise KeyError('Model %s not found in %s' %
+                                   (filename, MODEL_DATABASE))
+            model_data = descramble(blob)
             model = CubModel(ByteArrayReader(model_data))
             x = model.x_size
             y = model.y_size
@@ -241,24 +497,184 @@ class CubeModel(Model):
             self.size = Vector3(x, y, z)
             self.data = model.blocks
         else:
-            model = CubModel(ByteReader(open(filename, 'rb').read()))
+            with open(filename, 'rb') as f:
+                model = CubModel(ByteReader(f.read()))
             x = model.x_size
             y = model.y_size
             z = model.z_size
             self.size = Vector3(x, y, z)
             self.data = model.blocks
-            
-    def __descramble(self, model_data):
-        data_len = len(model_data)
-        
-        for i in range(data_len - 1, -1, -1):
-            offset = (i + OFFSET_LOOKUP_TABLE[i % 44]) % data_len
 
-            temp = model_data[i]
-            model_data[i] = model_data[offset]
-            model_data[offset] = temp
 
-        for i in range(0, data_len):
-            model_data[i] = ~(model_data[i]) + 256
-            
-        return model_data
\ No newline at end of file
+class ModelDatabase:
+    """Shared read only access to the models in data1.db."""
+    def __init__(self, path=MODEL_DATABASE):
+        """Creates a new ModelDatabase. The database is opened when the
+        first model is read.
+
+        Keyword arguments:
+        path -- Path of the database.
+
+        """
+        self.path = path
+        self.__connection = None
+        # the connection is shared with the model loading threads
+        self.__lock = threading.Lock()
+
+    def __get_connection(self):
+        if self.__connection is None:
+            uri = 'file:%s?mode=ro' % pathname2url(
+                os.path.abspath(self.path))
+            self.__connection = sqlite3.connect(uri, uri=True,
+                                                check_same_thread=False)
+        return self.__connection
+
+    def load_blob(self, name):
+        """Reads the scrambled blob of a model.
+
+        Keyword arguments:
+        name -- Name of the model.
+
+        Returns:
+        The blob or None if there is no such model.
+
+        """
+        with self.__lock:
+            row = self.__get_connection().execute(
+                'SELECT * FROM blobs WHERE key = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        return row[1]
+
+    def load_blobs(self, names):
+        """Reads the scrambled blobs of multiple models at once.
+
+        Keyword arguments:
+        names -- Names of the models.
+
+        Returns:
+        A dict mapping the names of the found models to their blobs.
+
+        """
+        names = list(set(names))
+        blobs = {}
+        with self.__lock:
+            connection = self.__get_connection()
+            # stay below SQLite's limit of query parameters
+            for i in range(0, len(names), MAX_QUERY_PARAMETERS):
+                part = names[i:i + MAX_QUERY_PARAMETERS]
+                query = ('SELECT * FROM blobs WHERE key IN (%s)' %
+                         ', '.join('?' * len(part)))
+                for row in connection.execute(query, part):
+                    blobs[row[0]] = row[1]
+        return blobs
+
+    def close(self):
+        """Closes the database."""
+        with self.__lock:
+            if self.__connection is not None:
+                self.__connection.close()
+                self.__connection = None
+
+
+def get_model_version(filename, from_database=False):
+    """Gets the version of a model's source, it changes whenever the
+    source file is modified.
+
+    Keyword arguments:
+    filename -- Name or path of the model.
+    from_database -- True if the model is loaded from data1.db.
+
+    Returns:
+    Tuple (modification time, size) of the source file.
+
+    """
+    path = MODEL_DATABASE if from_database else filename
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+class ModelCache:
+    """LRU cache of loaded models bounded by their number of blocks.
+    Cached models must not be modified, hand out copies instead.
+
+    """
+    def __init__(self, max_blocks=DEFAULT_MODEL_CACHE_BLOCKS):
+        """Creates a new ModelCache.
+
+        Keyword arguments:
+        max_blocks -- Maximum number of blocks of all cached models.
+
+        """
+        self.max_blocks = max_blocks
+        self.__models = OrderedDict() # key -> (version, model)
+        self.__block_count = 0
+
+    def __len__(self):
+        return len(self.__models)
+
+    def get_block_count(self):
+        """Gets the number of blocks of all cached models.
+
+        Returns:
+        The number of blocks.
+
+        """
+        return self.__block_count
+
+    def get(self, key, version):
+        """Gets a cached model.
+
+        Keyword arguments:
+        key -- Tuple (from database, name).
+        version -- Current version of the model's source.
+
+        Returns:
+        The model or None if it isn't cached or outdated.
+
+        """
+        entry = self.__models.get(key)
+        if entry is None:
+            return None
+        if entry[0] != version:
+            self.remove(key)
+            return None
+        self.__models.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, version, model):
+        """Adds a model to the cache, the least recently used models
+        are removed if the cache is full. Models larger than the whole
+        cache aren't added.
+
+        Keyword arguments:
+        key -- Tuple (from database, name).
+        version -- Version of the model's source.
+        model -- The model.
+
+        """
+        self.remove(key)
+        blocks = len(model)
+        if blocks > self.max_blocks:
+            return
+        models = self.__models
+        models[key] = (version, model)
+        self.__block_count += blocks
+        while self.__block_count > self.max_blocks:
+            self.remove(next(iter(models)))
+
+    def remove(self, key):
+        """Removes a model from the cache.
+
+        Keyword arguments:
+        key -- Tuple (from database, name).
+
+        """
+        entry = self.__models.pop(key, None)
+        if entry is not None:
+            self.__block_count -= len(entry[1])
+
+    def clear(self):
+        """Removes all models."""
+        self.__models.clear()
+        self.__block_count = 0
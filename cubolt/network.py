@@ -0,0 +1,269 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 Bjoern Lange
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# This file is part of CuBolt.
+
+
+"""Network helpers."""
+
+
+import struct
+import zlib
+
+from cuwo.bytes import ByteWriter
+from cuwo.packet import write_packet
+
+
+"""Limits of the number of block deltas sent to a client per update."""
+MIN_DELTA_BUDGET = 50
+MAX_DELTA_BUDGET = 10000
+DELTA_BUDGET_INCREASE = 250
+
+
+"""Write buffer sizes (in bytes) of a client's transport below which
+the budget grows and above which it is halved.
+
+"""
+LOW_WATER_MARK = 16 * 1024
+HIGH_WATER_MARK = 64 * 1024
+
+
+class DeltaPacer:
+    """Adapts the number of block deltas sent to a client per update
+    to the client's connection. The budget grows additively as long as
+    the client keeps up with the data sent and is halved as soon as
+    data piles up in the transport's write buffer (AIMD).
+    
+    """
+    def __init__(self, budget, minimum=MIN_DELTA_BUDGET,
+                 maximum=MAX_DELTA_BUDGET, increase=DELTA_BUDGET_INCREASE,
+                 low_water=LOW_WATER_MARK, high_water=HIGH_WATER_MARK):
+        """Creates a new DeltaPacer.
+        
+        Keyword arguments:
+        budget -- Initial number of block deltas per update
+        minimum -- Lower bound of the budget
+        maximum -- Upper bound of the budget
+        increase -- Amount the budget grows by per update
+        low_water -- Write buffer size below which the budget grows
+        high_water -- Write buffer size above which the budget shrinks
+        
+        """
+        self.budget = budget
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.low_water = low_water
+        self.high_water = high_water
+
+    def get_budget(self, transport, backlog):
+        """Updates and gets the budget for the current update.
+        
+        Keyword arguments:
+        transport -- Transport of the client
+        backlog -- Number of block deltas waiting to be sent
+        
+        Returns:
+        The number of block deltas to send.
+        
+        """
+        buffered = transport.get_write_buffer_size()
+        if buffered > self.high_water:
+            self.budget = max(self.minimum, self.budget // 2)
+        elif buffered <= self.low_water and backlog > self.budget:
+            self.budget = min(self.maximum, self.budget + self.increase)
+        return self.budget
+
+
+"""Sections of the update packet that are individual for each
+client.
+
+"""
+CLIENT_SECTIONS = ('items_1', 'particles', 'static_entities')
+
+
+def encode_items(items):
+    """Encodes the items of a packet section without their count.
+    
+    Keyword arguments:
+    items -- Items to encode
+    
+    Returns:
+    The encoded bytes.
+    
+    """
+    writer = ByteWriter()
+    for item in items:
+        item.write(writer)
+    return writer.get()
+
+
+class UpdatePacketEncoder:
+    """Encodes the update packet for multiple clients. Sections that
+    are the same for all clients are encoded once per update, only the
+    client specific sections are encoded for each client.
+
+    The section order is taken from the order in which the update
+    packet's reset method creates its lists, which is the order the
+    sections are written in. is_supported verifies this against cuwo's
+    own encoding.
+
+    Note that the whole body is still compressed for each client, so
+    the cost per client isn't yet proportional to its specific data
+    only.
+    
+    """
+    def __init__(self, update_packet):
+        """Creates a new UpdatePacketEncoder.
+        
+        Keyword arguments:
+        update_packet -- The server's update packet
+        
+        """
+        self.packet_id = update_packet.packet_id
+        self.sections = [name for name, value in vars(update_packet).items()
+                         if isinstance(value, list)]
+        self.__packet_class = type(update_packet)
+        self.__parts = []
+
+    def is_supported(self):
+        """Checks whether the update packet layout is known. A sample
+        packet is encoded with this encoder and with cuwo, the results
+        must be identical.
+        
+        Returns:
+        True if all client specific sections were found and the
+        encoding matches cuwo's, otherwise False.
+        
+        """
+        if not all(name in self.sections for name in CLIENT_SECTIONS):
+            return False
+        try:
+            return self.__verify()
+        except Exception:
+            return False
+
+    def __verify(self):
+        """Compares the encoding of a sample packet, each section holds
+        a different number of items writing the index of the section.
+        
+        Returns:
+        True if the encodings match, otherwise False.
+        
+        """
+        sample = self.__packet_class()
+        sample.reset()
+        for i, name in enumerate(self.sections):
+            setattr(sample, name, [MarkerItem(i)] * (i + 1))
+        expected = write_packet(sample)
+
+        # all items shared
+        self.encode_shared(sample)
+        if not packets_equal(self.encode({}), expected):
+            return False
+
+        # client specific items only
+        client_sections = {}
+        for name in CLIENT_SECTIONS:
+            client_sections[name] = getattr(sample, name)
+            setattr(sample, name, [])
+        self.encode_shared(sample)
+        result = packets_equal(self.encode(client_sections), expected)
+        self.__parts = []
+        return result
+
+    def encode_shared(self, update_packet):
+        """Encodes the shared sections of the update packet. Has to be
+        called once per update before encoding packets for clients.
+        
+        Keyword arguments:
+        update_packet -- The server's update packet
+        
+        """
+        parts = []
+        pack = struct.pack
+        for name in self.sections:
+            items = getattr(update_packet, name)
+            if items is None:
+                items = []
+            if name in CLIENT_SECTIONS:
+                parts.append((name, len(items), encode_items(items)))
+            else:
+                parts.append(pack('<I', len(items)) + encode_items(items))
+        self.__parts = parts
+
+    def encode(self, client_sections):
+        """Encodes the update packet for a client. The client specific
+        items are placed in front of the shared items of a section.
+        
+        Keyword arguments:
+        client_sections -- Dict mapping the names of client specific
+            sections to lists of items
+        
+        Returns:
+        The encoded packet, ready to be written to a transport.
+        
+        """
+        data = []
+        pack = struct.pack
+        for part in self.__parts:
+            if isinstance(part, bytes):
+                data.append(part)
+                continue
+            name, shared_count, shared_data = part
+            items = client_sections.get(name, ())
+            data.append(pack('<I', len(items) + shared_count))
+            if items:
+                data.append(encode_items(items))
+            data.append(shared_data)
+        compressed = zlib.compress(b''.join(data))
+        return pack('<II', self.packet_id, len(compressed)) + compressed
+
+
+class MarkerItem:
+    """Packet item writing a single byte, used to verify layouts."""
+    def __init__(self, value):
+        self.value = value
+
+    def write(self, writer):
+        writer.write_uint8(self.value)
+
+
+def packets_equal(a, b):
+    """Compares two encoded update packets. Packets compressed with
+    different settings are equal if their bodies are.
+    
+    Keyword arguments:
+    a -- First packet
+    b -- Second packet
+    
+    Returns:
+    True if the packets are equal, otherwise False.
+    
+    """
+    if a == b:
+        return True
+    if a[:4] != b[:4]:
+        return False
+    return zlib.decompress(a[8:]) == zlib.decompress(b[8:])
@@ -73,9 +73,8 @@ class ParticleEffect:
                 
     def fire(self):
         """Fires the particle effect."""
-        cubolt = self.server.scripts.cubolt
-        px = self.data.pos.x / (BLOCK_SCALE * 256)
-        py = self.data.pos.y / (BLOCK_SCALE * 256)
-        for connection_script in cubolt.children:
-            if connection_script.is_near(px, py):
-                connection_script.particles.append(self.data)
\ No newline at end of file
+        subscribers = self.server.chunk_subscribers
+        px = int(self.data.pos.x / (BLOCK_SCALE * 256))
+        py = int(self.data.pos.y / (BLOCK_SCALE * 256))
+        for connection_script in subscribers.get_subscribers(px, py):
+            connection_script.particles.append(self.data)
\ No newline at end of file
@@ -0,0 +1,350 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 Bjoern Lange
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# This file is part of CuBolt.
+
+
+"""Persistence of CuBolt block edits."""
+
+
+import os
+import os.path
+import sqlite3
+import struct
+import sys
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+
+"""Format of an overlay: a header holding the number of columns,
+followed by a table of (index, number of blocks, offset) entries sorted
+by column index. The offsets point to the packed blocks of each column:
+the z coordinates as little endian int32, followed by 3 color bytes and
+one type byte per block. The fixed layout allows to read single
+columns without decoding the whole overlay.
+
+"""
+OVERLAY_HEADER = struct.Struct('<4sI')
+OVERLAY_ENTRY = struct.Struct('<HII')
+OVERLAY_MAGIC = b'CBO2'
+
+
+def encode_column(zs, colors, types):
+    """Encodes the blocks of a column.
+    
+    Keyword arguments:
+    zs -- Sorted absolute z coordinates.
+    colors -- 3 color bytes per block.
+    types -- Type byte per block.
+    
+    Returns:
+    The encoded bytes.
+    
+    """
+    z_data = array('i', zs)
+    if sys.byteorder != 'little':
+        z_data.byteswap()
+    return z_data.tobytes() + bytes(colors) + bytes(types)
+
+
+def build_overlay(columns):
+    """Builds an overlay from encoded columns.
+    
+    Keyword arguments:
+    columns -- Iterable of (index, number of blocks, data) tuples, data
+        as returned by encode_column.
+    
+    Returns:
+    The encoded bytes.
+    
+    """
+    columns = sorted(column for column in columns if column[1])
+    offset = OVERLAY_HEADER.size + OVERLAY_ENTRY.size * len(columns)
+    table = [OVERLAY_HEADER.pack(OVERLAY_MAGIC, len(columns))]
+    for index, block_count, data in columns:
+        table.append(OVERLAY_ENTRY.pack(index, block_count, offset))
+        offset += len(data)
+    return b''.join(table) + b''.join(data for _, _, data in columns)
+
+
+def encode_overlay(columns):
+    """Encodes the edits of a chunk.
+    
+    Keyword arguments:
+    columns -- Iterable of (index, zs, colors, types) tuples, zs are
+        the sorted absolute z coordinates, colors hold 3 bytes and types
+        one byte per block.
+    
+    Returns:
+    The encoded bytes.
+    
+    """
+    return build_overlay((index, len(zs), encode_column(zs, colors, types))
+                         for index, zs, colors, types in columns)
+
+
+class OverlayView:
+    """Read only view of an encoded overlay. Only the column table is
+    read when the view is created, the blocks of a column are decoded
+    when it is requested.
+    
+    """
+    def __init__(self, data):
+        """Creates a new OverlayView.
+        
+        Keyword arguments:
+        data -- Encoded overlay, any object supporting the buffer
+            protocol.
+        
+        """
+        magic, count = OVERLAY_HEADER.unpack_from(data, 0)
+        if magic != OVERLAY_MAGIC:
+            raise ValueError('Not a CuBolt overlay')
+        self.__data = memoryview(data)
+        table_end = OVERLAY_HEADER.size + OVERLAY_ENTRY.size * count
+        self.__columns = {index : (block_count, offset)
+                          for index, block_count, offset in
+                          OVERLAY_ENTRY.iter_unpack(
+                              self.__data[OVERLAY_HEADER.size:table_end])}
+
+    def __len__(self):
+        return len(self.__columns)
+
+    def __contains__(self, index):
+        return index in self.__columns
+
+    def get_indices(self):
+        """Gets the indices of all stored columns.
+        
+        Returns:
+        A list of column indices (x + y * 256).
+        
+        """
+        return list(self.__columns)
+
+    def get_column_data(self, index):
+        """Gets the encoded blocks of a column without decoding them.
+        
+        Keyword arguments:
+        index -- Column index (x + y * 256).
+        
+        Returns:
+        Tuple (number of blocks, data) in the format of encode_column.
+        None if the column isn't stored.
+        
+        """
+        entry = self.__columns.get(index)
+        if entry is None:
+            return None
+        block_count, offset = entry
+        return (block_count,
+                bytes(self.__data[offset:offset + block_count * 8]))
+
+    def get_zs(self, index):
+        """Decodes the z coordinates of a column only.
+        
+        Keyword arguments:
+        index -- Column index (x + y * 256).
+        
+        Returns:
+        The sorted z coordinates as array('i').
+        
+        """
+        block_count, offset = self.__columns[index]
+        zs = array('i')
+        zs.frombytes(self.__data[offset:offset + block_count * 4])
+        if sys.byteorder != 'little':
+            zs.byteswap()
+        return zs
+
+    def get_block_data(self, index, i):
+        """Reads a single block of a column.
+        
+        Keyword arguments:
+        index -- Column index (x + y * 256).
+        i -- Position of the block in the column's z coordinates.
+        
+        Returns:
+        Tuple (red, green, blue, type).
+        
+        """
+        block_count, offset = self.__columns[index]
+        data = self.__data
+        colors_offset = offset + block_count * 4 + i * 3
+        return (data[colors_offset], data[colors_offset + 1],
+                data[colors_offset + 2], data[offset + block_count * 7 + i])
+
+    def get_column(self, index):
+        """Decodes a column.
+        
+        Keyword arguments:
+        index -- Column index (x + y * 256).
+        
+        Returns:
+        Tuple (zs, colors, types), zs is an array('i'), colors and types
+        are bytes. None if the column isn't stored.
+        
+        """
+        entry = self.__columns.get(index)
+        if entry is None:
+            return None
+        block_count, offset = entry
+        data = self.__data
+        colors_offset = offset + block_count * 4
+        types_offset = colors_offset + block_count * 3
+        zs = array('i')
+        zs.frombytes(data[offset:colors_offset])
+        if sys.byteorder != 'little':
+            zs.byteswap()
+        return (zs, bytes(data[colors_offset:types_offset]),
+                bytes(data[types_offset:types_offset + block_count]))
+
+
+"""Maximum number of bytes of the overlay database SQLite maps into
+memory for reading.
+
+"""
+STORE_MMAP_SIZE = 256 * 1024 * 1024
+
+
+class SQLiteOverlayStore:
+    """Stores the edits of each chunk in a SQLite database in WAL
+    mode. Saved overlays are collected and written in one transaction
+    per flush by a background thread, so saving never blocks on disk.
+    
+    """
+    def __init__(self, path):
+        """Creates a new SQLiteOverlayStore.
+        
+        Keyword arguments:
+        path -- Path of the database file, it is created if it doesn't
+            exist.
+        
+        """
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.__connection = sqlite3.connect(path)
+        self.__connection.execute('PRAGMA journal_mode=WAL')
+        # reads are served from a memory mapping of the database file
+        self.__connection.execute('PRAGMA mmap_size=%d' % STORE_MMAP_SIZE)
+        self.__connection.execute('CREATE TABLE IF NOT EXISTS overlays '
+                                  '(x INTEGER, y INTEGER, data BLOB, '
+                                  'PRIMARY KEY (x, y))')
+        self.__connection.commit()
+
+        self.__pending = {} # pos -> data, not handed to the writer yet
+        self.__writing = {} # pos -> data, currently being written
+        self.__executor = ThreadPoolExecutor(max_workers=1)
+        self.__writer = None # connection of the writer thread
+        self.__future = None
+
+    def save(self, pos, data):
+        """Saves the edits of a chunk with the next flush.
+        
+        Keyword arguments:
+        pos -- Tuple (chunk x, chunk y).
+        data -- Encoded overlay.
+        
+        """
+        self.__pending[pos] = data
+
+    def load(self, pos):
+        """Loads the edits of a chunk.
+        
+        Keyword arguments:
+        pos -- Tuple (chunk x, chunk y).
+        
+        Returns:
+        The encoded overlay or None if there are no edits stored.
+        
+        """
+        data = self.__pending.get(pos)
+        if data is None:
+            data = self.__writing.get(pos)
+        if data is not None:
+            return data
+        row = self.__connection.execute(
+            'SELECT data FROM overlays WHERE x = ? AND y = ?', pos).fetchone()
+        if row is None:
+            return None
+        # the blob is copied once, OverlayView reads it without copies
+        return row[0]
+
+    def flush(self):
+        """Hands all saved overlays to the writer thread. If the
+        previous batch is still being written, they are kept for the
+        next flush.
+        
+        """
+        future = self.__future
+        if future is not None:
+            if not future.done():
+                return
+            self.__future = None
+            error = future.exception()
+            if error is not None:
+                print('[CB] Saving block edits failed: %s' % error)
+                for pos, data in self.__writing.items():
+                    self.__pending.setdefault(pos, data)
+            self.__writing = {}
+
+        if self.__pending:
+            batch = self.__pending
+            self.__pending = {}
+            self.__writing = batch
+            self.__future = self.__executor.submit(self.__write, batch)
+
+    def __write(self, batch):
+        """Writes a batch of overlays, runs in the writer thread.
+        
+        Keyword arguments:
+        batch -- Dict mapping positions to encoded overlays.
+        
+        """
+        if self.__writer is None:
+            self.__writer = sqlite3.connect(self.path)
+            self.__writer.execute('PRAGMA synchronous=NORMAL')
+        with self.__writer:
+            self.__writer.executemany(
+                'INSERT OR REPLACE INTO overlays (x, y, data) '
+                'VALUES (?, ?, ?)',
+                [(x, y, data) for (x, y), data in batch.items()])
+
+    def close(self):
+        """Writes all saved overlays and closes the database."""
+        if self.__future is not None:
+            self.__future.exception()
+        self.flush()
+        if self.__future is not None:
+            self.__future.exception()
+            self.flush()
+
+        def close_writer():
+            if self.__writer is not None:
+                self.__writer.close()
+        self.__executor.submit(close_writer)
+        self.__executor.shutdown(wait=True)
+        self.__connection.close()
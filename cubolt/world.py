@@ -31,6 +31,10 @@
 import sqlite3
 import os.path
 import sys
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
 
 from cuwo.constants import FULL_MASK
 from cuwo.packet import ChunkItems
@@ -47,17 +51,78 @@ try:
 except ImportError:
     block_types_available = False
 
+try:
+    import numpy
+    numpy_available = True
+except ImportError:
+    numpy_available = False
+
 from .exceptions import IndexBelowWorldException
+from .interest import get_chunk_pos
+from .storage import build_overlay
+from .storage import encode_column
+from .storage import OverlayView
+
+
+"""Marks heights in a height map that haven't been computed yet. Heights
+are signed as columns may end below the sea level, the marker is the
+lowest value of the map's array type.
+
+"""
+HEIGHT_UNKNOWN = -2 ** 31
+
+
+"""Layout of the type byte of an overridden block: the block type in
+the lower bits and the breakable flag.
+
+"""
+BLOCK_TYPE_MASK = 0b00011111
+BREAKABLE_FLAG = 0b00100000
+
+
+"""Default number of unedited column proxies kept server wide."""
+DEFAULT_PROXY_CACHE_SIZE = 65536
+
+
+"""Interval (in seconds) in which edited chunks are saved."""
+SAVE_INTERVAL = 5.0
+
+
+"""Default time (in seconds) after which a chunk no player has been
+near is unloaded and the interval in which chunks are checked.
+
+"""
+DEFAULT_UNLOAD_TIMEOUT = 300.0
+UNLOAD_CHECK_INTERVAL = 10.0
+
+
+"""Default radius (in chunks) of the ring prefetched around players,
+the time (in seconds) a player's movement is extrapolated to prefetch
+the chunks ahead and the maximum number of chunks generated at once.
+
+"""
+DEFAULT_PREFETCH_RADIUS = 2
+DEFAULT_PREFETCH_LOOKAHEAD = 5.0
+DEFAULT_MAX_PENDING_CHUNKS = 4
+PREFETCH_INTERVAL = 0.5
+
 
 class CuBoltChunk:
     data = None
+    # inserted
+    unloaded = False
+    # inserted end
 
     def __init__(self, world, pos):
         self.world = world
         self.pos = pos
         self.items = []
         self.static_entities = {}
-        self.block_cache = []
+        self.block_cache = BlockEditLog()
+        # inserted
+        self.last_visit = time.time()
+        self.spawned_entities = [] # entities spawned with this chunk
+        # inserted end
 
         if not world.use_tgen:
             return
@@ -81,6 +146,7 @@ class CuBoltChunk:
             for data in self.data.dynamic_entities:
                 entity = self.world.create_entity(data.entity_id)
                 data.set_entity(entity)
+                self.spawned_entities.append(entity)
                 
                 # inserted
                 cb = entity.cubolt_entity
@@ -99,15 +165,74 @@ class CuBoltChunk:
         self.update()
         
         # inserted
-        # do the cached calls that have been made before the chunk
-        # was loaded
-        for (pos, block) in self.block_cache:
-            self.set_block(pos, block)
+        # restore the edits saved when the chunk was unloaded
+        store = self.world.server.overlay_store
+        if block_types_available and store is not None:
+            overlay = store.load(self.get_chunk_pos())
+            if overlay is not None:
+                self.data._attach_overlay(OverlayView(overlay))
+
+        # merge the edits that have been made before the chunk was
+        # loaded
+        if block_types_available and self.block_cache:
+            self.data._merge_edits(self.block_cache)
         self.block_cache = None
 
         self.world.server.scripts.call('on_chunk_load', chunk=self)
         # inserted end
 
+    def get_chunk_pos(self):
+        """Gets the position of this chunk.
+        
+        Returns:
+        Tuple (chunk x, chunk y).
+
+        """
+        return (int(self.pos.x), int(self.pos.y))
+
+    def can_unload(self):
+        """Checks whether this chunk can be unloaded without losing
+        data.
+        
+        Returns:
+        True if the chunk can be unloaded, otherwise False.
+
+        """
+        return self.data is not None and not self.items
+
+    def unload(self):
+        """Unloads this chunk. Its edits are saved to the server's
+        overlay store, its entities are destroyed and its data is
+        released. The chunk must be removed from the world afterwards,
+        later edits through this object are forwarded to the new chunk.
+
+        """
+        server = self.world.server
+        server.scripts.call('on_chunk_unload', chunk=self)
+
+        data = self.data
+        if block_types_available:
+            store = server.overlay_store
+            if (store is not None and
+                    server.edited_chunks.pop((data.x, data.y), None)):
+                store.save(self.get_chunk_pos(), data._get_overlay_data())
+            data._release()
+
+        entities = self.world.entities
+        # IDs of dead entities may have been reused by others
+        destroy_ids = [entity.entity_id for entity in self.spawned_entities
+                       if entities.get(entity.entity_id) is entity]
+        self.world.destroy_many(destroy_ids)
+        self.spawned_entities = []
+
+        server.updated_chunks.discard(self)
+        for con_script in server.scripts.cubolt.children:
+            if self in con_script.chunks:
+                con_script.chunks.remove(self)
+        self.static_entities = {}
+        self.data = None
+        self.unloaded = True
+
     def add_item(self, item):
         self.items.append(item)
         self.update()
@@ -150,6 +275,37 @@ class CuBoltChunk:
         else:
             return None
 
+    def get_stats(self):
+        """Gets memory usage counters of this chunk.
+        
+        Returns:
+        A dict as returned by CuBoltTGenChunk.get_stats or None if the
+        chunk isn't loaded yet.
+
+        """
+        if self.data is None or not block_types_available:
+            return None
+        return self.data.get_stats()
+
+    def _read_region(self, region, x0, x1, y0, y1):
+        """Reads blocks of this chunk into a region.
+        
+        Keyword arguments:
+        region -- BlockRegion to fill.
+        x0 -- First absolute x coordinate to read.
+        x1 -- Absolute x coordinate to stop reading at.
+        y0 -- First absolute y coordinate to read.
+        y1 -- Absolute y coordinate to stop reading at.
+
+        Returns:
+        True if the chunk was read, False if it isn't loaded yet.
+
+        """
+        if self.data is None or not block_types_available:
+            return False
+        self.data._read_region(region, x0, x1, y0, y1)
+        return True
+
     def set_block(self, position, block):
         """Sets a block in this chunk.
         
@@ -158,23 +314,44 @@ class CuBoltChunk:
         block -- The block to set.
 
         """
-        if self.data is None: # Need to cache calls and do them later
-            self.block_cache.append((position, block))
+        if self.unloaded: # the world holds a new chunk for this position
+            self.world.get_chunk(self.pos).set_block(position, block)
+        elif self.data is None: # Need to cache calls and do them later
+            p = position
+            self.block_cache.add(int(p.x), int(p.y), int(p.z), block)
         elif block_types_available:
             self.data.set_block(position, block)
 
+    def set_blocks(self, blocks):
+        """Sets multiple blocks in this chunk at once. Clients are
+        only invalidated once for all blocks.
+        
+        Keyword arguments:
+        blocks -- Iterable of ((x, y, z), block) tuples. X, Y, Z
+            coordinates from 0-255.
+
+        """
+        if self.unloaded: # the world holds a new chunk for this position
+            self.world.get_chunk(self.pos).set_blocks(blocks)
+        elif self.data is None: # Need to cache calls and do them later
+            self.block_cache.extend(blocks)
+        elif block_types_available:
+            self.data.set_blocks(blocks)
+
     def _append_deltas(self, deltas):
         """Appends the deltas for this chunk. Access to data is safe
         here.
         
         Keyword arguments:
-        deltas -- List to append to.
+        deltas -- BlockDeltaQueue to append to.
 
         """
         self.data._append_deltas(deltas)
 
 
 class CuBoltTGenChunk:
+    released = False
+
     def __init__(self, server, tgen_chunk):
         self.__server = server
         self.__tgen_chunk = tgen_chunk
@@ -184,7 +361,18 @@ class CuBoltTGenChunk:
         self.x = tgen_chunk.x
         self.y = tgen_chunk.y
 
+        # Proxies of columns holding edits, all other proxies are only
+        # kept in the server's ProxyCache
         self.__proxies = {}
+        # Encoded overlays of the edited columns, form:
+        # <index:(index, number of blocks, data)>
+        self.__encoded = {}
+        # OverlayView of stored edits whose columns haven't been
+        # accessed yet
+        self.__stored = None
+        # Height (first not allocated block) of each column, computed
+        # on first access, HEIGHT_UNKNOWN if not computed yet
+        self.__heights = array('i', [HEIGHT_UNKNOWN]) * (256 * 256)
 
         self.get_render = tgen_chunk.get_render
 
@@ -208,39 +396,329 @@ class CuBoltTGenChunk:
                 self.get_solid(x, y, z - 1)) 
 
     def get_dict(self): 
+        """Gets the visible blocks of this chunk.
+        
+        Returns:
+        A dict mapping (x, y, z) to colors.
+
+        """
+        if numpy_available:
+            volume = self.get_volume()
+            visible = volume.get_surface()
+            colors = volume.colors
+            z_offset = volume.z_offset
+            blocks = {}
+            for x, y, z in zip(*numpy.nonzero(visible)):
+                blocks[(int(x), int(y), int(z) + z_offset)] = \
+                    tuple(colors[x, y, z].tolist())
+            return blocks
+
+        # without NumPy the same blocks are collected column by
+        # column, colors are those get_block returns
+        self.__load_all_stored()
+        server = self.__server
+        tgen_chunk = self.__tgen_chunk
+        columns = []
+        for i in range(256 * 256):
+            proxy = self.__proxies.get(i)
+            if proxy is None:
+                # not cached, a whole chunk would flush the ProxyCache
+                proxy = CuBoltXYProxy(server, self, tgen_chunk[i],
+                                      i % 256, i // 256)
+            columns.append(proxy)
+
+        def is_solid(x, y, z):
+            if x < 0 or x >= 256 or y < 0 or y >= 256:
+                return False
+            return columns[x + y * 256]._is_solid(z)
+
         blocks = {}
- 
-        for i in range(256*256): 
-            x = i % 256 
-            y = i / 256 
-            xy = self[x + y * 256] 
-            for z in range(xy.b, (xy.a + len(xy))): 
-                if self.get_neighbor_solid(x, y, z): 
+        for i, column in enumerate(columns):
+            x = i % 256
+            y = i // 256
+            for z in range(column.b, column._get_top()):
+                if not column._is_solid(z):
                     continue
-                if z < xy.a: 
-                    blocks[(x, y, z)] = xy[0] 
+                if (is_solid(x - 1, y, z) and is_solid(x + 1, y, z) and
+                        is_solid(x, y - 1, z) and is_solid(x, y + 1, z) and
+                        (z - 1 < column.b or column._is_solid(z - 1)) and
+                        column._is_solid(z + 1)):
                     continue
-                if xy.get_type(z - xy.a) == EMPTY_TYPE: 
-                    continue
-                blocks[(x, y, z)] = xy[z - xy.a]
+                blocks[(x, y, z)] = column.get_block(z).color
         return blocks
 
+    def get_volume(self):
+        """Exports this chunk as dense arrays, CuBolt edits are applied.
+        Needs NumPy.
+        
+        Returns:
+        A ChunkVolume.
+
+        """
+        self.__load_all_stored()
+        tgen_chunk = self.__tgen_chunk
+        proxies = self.__proxies
+        columns = [tgen_chunk[i] for i in range(256 * 256)]
+
+        # determine the z range
+        z_min = min(column.b for column in columns)
+        z_max = max(column.a + len(column) for column in columns)
+        for proxy in proxies.values():
+            zs = proxy._get_overlay()[0]
+            if zs:
+                z_min = min(z_min, zs[0])
+                z_max = max(z_max, zs[-1] + 1)
+        depth = max(z_max - z_min, 1)
+
+        types = numpy.full((256, 256, depth), EMPTY_TYPE, numpy.uint8)
+        colors = numpy.zeros((256, 256, depth, 3), numpy.uint8)
+        breakable = numpy.zeros((256, 256, depth), numpy.bool_)
+        bottom = numpy.empty((256, 256), numpy.int32)
+
+        # native data, only the allocated part of a column needs to be
+        # read block by block
+        for i, column in enumerate(columns):
+            x = i % 256
+            y = i // 256
+            a = column.a - z_min
+            b = column.b - z_min
+            bottom[x, y] = b
+            types[x, y, :a] = MOUNTAIN_TYPE
+            colors[x, y, b:a] = 128
+            column_types = types[x, y]
+            column_colors = colors[x, y]
+            column_breakable = breakable[x, y]
+            for rel_z in range(len(column)):
+                column_types[a + rel_z] = column.get_type(rel_z)
+                column_colors[a + rel_z] = column[rel_z]
+                column_breakable[a + rel_z] = column.get_breakable(rel_z)
+
+        # CuBolt edits
+        for index, proxy in proxies.items():
+            zs, block_colors, block_types = proxy._get_overlay()
+            if not zs:
+                continue
+            x = index % 256
+            y = index // 256
+            z = numpy.frombuffer(zs, numpy.int32) - z_min
+            t = numpy.frombuffer(block_types, numpy.uint8)
+            types[x, y, z] = t & BLOCK_TYPE_MASK
+            colors[x, y, z] = numpy.frombuffer(block_colors,
+                                               numpy.uint8).reshape(-1, 3)
+            breakable[x, y, z] = (t & BREAKABLE_FLAG) != 0
+
+        solid = types != EMPTY_TYPE
+        # empty blocks up to z = 0 are water
+        sea = types[:, :, :max(1 - z_min, 0)]
+        sea[sea == EMPTY_TYPE] = WATER_TYPE
+        return ChunkVolume(z_min, types, colors, breakable, solid, bottom)
+
     def get_height(self, x, y):
-        data = self[x + y * 256]
-        return data.height
+        """Gets the height of a column.
+        
+        Keyword arguments:
+        x -- X chunk coordinate (0-255).
+        y -- Y chunk coordinate (0-255).
+
+        Returns:
+        The z coordinate of the first block above the column.
+
+        """
+        return self._get_height(int(x) + int(y) * 256)
+
+    def get_height_map(self):
+        """Gets the heights of all columns.
+        
+        Returns:
+        An array('i') indexed by x + y * 256, holding the z coordinate
+        of the first block above each column.
+
+        """
+        heights = self.__heights
+        if HEIGHT_UNKNOWN in heights:
+            for index in range(256 * 256):
+                if heights[index] == HEIGHT_UNKNOWN:
+                    self._get_height(index)
+        return heights
+
+    def _get_height(self, index):
+        """Gets the height of a column by index.
+        
+        Keyword arguments:
+        index -- Column index (x + y * 256).
+
+        """
+        height = self.__heights[index]
+        if height == HEIGHT_UNKNOWN:
+            if self.__stored is not None and index in self.__stored:
+                # decoding the stored column sets its height
+                self[index]
+                return self.__heights[index]
+            native_proxy = self.__tgen_chunk[index]
+            height = native_proxy.a + len(native_proxy)
+            self.__heights[index] = height
+        return height
+
+    def _set_height(self, index, height):
+        """Sets the height of a column by index.
+        
+        Keyword arguments:
+        index -- Column index (x + y * 256).
+        height -- New height.
+
+        """
+        self.__heights[index] = height
 
     def __getitem__(self, index):
         index = int(index)
-        if index in self.__proxies:
-            return self.__proxies[index]
-        else:
+        proxy = self.__proxies.get(index)
+        if proxy is not None:
+            return proxy
+        if self.__stored is not None and index in self.__stored:
+            return self.__load_stored(index)
+        cache = self.__server.proxy_cache
+        key = (self.x, self.y, index)
+        proxy = cache.get(key)
+        if proxy is None:
             native_proxy = self.__tgen_chunk[index]
             server = self.__server
             x = index % 256
-            y = index / 256
-            cb_proxy = CuBoltXYProxy(server, self, native_proxy, x, y)
-            self.__proxies[index] = cb_proxy
-            return cb_proxy
+            y = index // 256
+            proxy = CuBoltXYProxy(server, self, native_proxy, x, y)
+            cache.put(key, proxy)
+        return proxy
+
+    def _pin(self, index, proxy):
+        """Keeps the proxy of an edited column for the lifetime of this
+        chunk.
+        
+        Keyword arguments:
+        index -- Column index (x + y * 256).
+        proxy -- The column's proxy.
+
+        Returns:
+        The pinned proxy of the column, which may be a different one
+        if the column has been pinned before.
+
+        """
+        pinned = self.__proxies.get(index)
+        if pinned is None:
+            self.__server.proxy_cache.remove((self.x, self.y, index))
+            self.__proxies[index] = proxy
+            pinned = proxy
+        return pinned
+
+    def has_edits(self):
+        """Checks whether any block of this chunk has been edited.
+        
+        Returns:
+        True if there are edits, otherwise False.
+
+        """
+        return bool(self.__proxies) or bool(self.__stored)
+
+    def _get_overlay_data(self):
+        """Encodes the edits of this chunk.
+        
+        Returns:
+        The encoded overlay.
+
+        """
+        # columns are only encoded again if they have been changed
+        encoded = self.__encoded
+        columns = []
+        for index, proxy in self.__proxies.items():
+            column = encoded.get(index)
+            if column is None:
+                zs, colors, types = proxy._get_overlay()
+                column = (index, len(zs), encode_column(zs, colors, types))
+                encoded[index] = column
+            columns.append(column)
+        stored = self.__stored
+        if stored is not None:
+            columns.extend((index,) + stored.get_column_data(index)
+                           for index in stored.get_indices()
+                           if index not in self.__proxies)
+        return build_overlay(columns)
+
+    def _attach_overlay(self, overlay):
+        """Attaches stored edits to this chunk without invalidating
+        clients. The columns are decoded when they are accessed for the
+        first time.
+        
+        Keyword arguments:
+        overlay -- OverlayView of the stored edits.
+
+        """
+        self.__load_all_stored()
+        for index in overlay.get_indices():
+            if index in self.__proxies:
+                continue
+            self.__heights[index] = HEIGHT_UNKNOWN
+            self.__server.proxy_cache.remove((self.x, self.y, index))
+        self.__stored = overlay
+
+    def __load_stored(self, index):
+        """Decodes a stored column and pins its proxy.
+        
+        Keyword arguments:
+        index -- Column index (x + y * 256).
+
+        Returns:
+        The pinned proxy of the column.
+
+        """
+        zs, colors, types = self.__stored.get_column(index)
+        native_proxy = self.__tgen_chunk[index]
+        proxy = CuBoltXYProxy(self.__server, self, native_proxy,
+                              index % 256, index // 256)
+        self.__proxies[index] = proxy
+        proxy._set_overlay(zs, colors, types)
+        return proxy
+
+    def __load_all_stored(self):
+        """Decodes all stored columns that haven't been accessed yet."""
+        stored = self.__stored
+        if stored is None:
+            return
+        for index in stored.get_indices():
+            if index not in self.__proxies:
+                self.__load_stored(index)
+        self.__stored = None
+
+    def _release(self):
+        """Releases the proxies of this chunk. Later edits through this
+        chunk or its proxies are forwarded to the world.
+
+        """
+        self.__server.proxy_cache.remove_chunk((self.x, self.y))
+        self.__proxies = {}
+        self.__stored = None
+        self.__encoded = {}
+        self.released = True
+
+    def get_stats(self):
+        """Gets memory usage counters of this chunk.
+        
+        Returns:
+        A dict with the number of pinned (edited) proxies, the number
+        of cached unedited proxies, the number of overridden blocks and
+        the number of stored columns that haven't been decoded yet.
+
+        """
+        overrides = 0
+        for proxy in self.__proxies.values():
+            overrides += len(proxy._get_overlay()[0])
+        stored = self.__stored
+        return {
+            'pinned_proxies' : len(self.__proxies),
+            'cached_proxies' : self.__server.proxy_cache.get_count(
+                (self.x, self.y)),
+            'overrides' : overrides,
+            'stored_columns' : len([index for index in stored.get_indices()
+                                    if index not in self.__proxies])
+                               if stored is not None else 0,
+        }
 
     def get_column(self, x, y):
         """Gets a "column" of blocks of this chunk by coordinates.
@@ -281,30 +759,172 @@ class CuBoltTGenChunk:
         x = int(p.x)
         y = int(p.y)
         z = int(p.z)
+        if self.released: # the world holds a new chunk for this position
+            self.__server.world.set_block(
+                Vector3(x + self.x * 256, y + self.y * 256, z), block)
+            return
         proxy = self.get_column(x, y)
         proxy.set_block(z, block)
 
+    def _read_region(self, region, x0, x1, y0, y1):
+        """Reads blocks of this chunk into a region.
+        
+        Keyword arguments:
+        region -- BlockRegion to fill.
+        x0 -- First absolute x coordinate to read.
+        x1 -- Absolute x coordinate to stop reading at.
+        y0 -- First absolute y coordinate to read.
+        y1 -- Absolute y coordinate to stop reading at.
+
+        """
+        base_x = self.x * 256
+        base_y = self.y * 256
+        z0 = region.z
+        z1 = z0 + region.size_z
+        tgen_chunk = self.__tgen_chunk
+        proxies = self.__proxies
+        stored = self.__stored
+        # unedited columns are read natively, so large regions don't
+        # flush the ProxyCache
+        for x in range(x0, x1):
+            for y in range(y0, y1):
+                index = (x - base_x) + (y - base_y) * 256
+                offset = region.get_index(x, y, z0)
+                read_native_column(tgen_chunk[index], z0, z1, region,
+                                   offset)
+                proxy = proxies.get(index)
+                if proxy is None and stored is not None and index in stored:
+                    proxy = self.__load_stored(index)
+                if proxy is not None:
+                    proxy._read_overlay(z0, z1, region, offset)
+
+    def set_blocks(self, blocks):
+        """Sets multiple blocks in this chunk at once. The blocks are
+        grouped by column and clients are only invalidated once.
+        
+        Keyword arguments:
+        blocks -- Iterable of ((x, y, z), block) tuples. X, Y, Z
+            coordinates from 0-255.
+
+        """
+        if self.released: # the world holds a new chunk for this position
+            base_x = self.x * 256
+            base_y = self.y * 256
+            self.__server.world.set_blocks(
+                ((int(x) + base_x, int(y) + base_y, z), block)
+                for (x, y, z), block in blocks)
+            return
+        columns = {} # index -> [(z, block)]
+        for (x, y, z), block in blocks:
+            index = int(x) + int(y) * 256
+            if index in columns:
+                columns[index].append((int(z), block))
+            else:
+                columns[index] = [(int(z), block)]
+
+        changed = []
+        try:
+            for index, column_blocks in columns.items():
+                proxy = self[index]
+                for z, block in column_blocks:
+                    changed.append(proxy._set_block(z, block))
+        finally:
+            # blocks set before an error are kept, so they have to be
+            # sent to the clients as well
+            if changed:
+                self._invalidate(changed)
+
+    def _merge_edits(self, edits):
+        """Merges edits made before this chunk was loaded directly into
+        the column overlays. Clients are invalidated once afterwards.
+        
+        Keyword arguments:
+        edits -- BlockEditLog holding the edits.
+
+        """
+        changed = []
+        for index, zs, colors, types in edits.get_columns():
+            proxy = self._pin(index, self[index])
+            changed.extend(proxy._merge_overlay(zs, colors, types))
+        self._invalidate(changed)
+
+    def _invalidate(self, changed):
+        """Invalidates blocks. This means that they will be
+        retransferred to the clients near this chunk as soon as
+        possible.
+        
+        Keyword arguments:
+        changed -- (x, y, z, column) tuples of the changed blocks.
+
+        """
+        server = self.__server
+        server.edited_chunks[(self.x, self.y)] = self
+        base_x = self.x * 256
+        base_y = self.y * 256
+        encoded = self.__encoded
+        for x, y, z, column in changed:
+            encoded.pop((x - base_x) + (y - base_y) * 256, None)
+        for con_script in server.chunk_subscribers.get_subscribers(self.x,
+                                                                   self.y):
+            con_script.block_deltas.extend(changed)
+
     def _append_deltas(self, deltas):
         """Appends the deltas for this chunk.
         
         Keyword arguments:
-        deltas -- List to append to.
+        deltas -- BlockDeltaQueue to append to.
 
         """
-        for proxy in self.__proxies.values():
+        proxies = self.__proxies
+        for proxy in proxies.values():
             proxy._append_deltas(deltas)
+        # stored columns are read from the overlay when the deltas are
+        # sent, they don't need to be decoded
+        stored = self.__stored
+        if stored is not None:
+            base_x = self.x * 256
+            base_y = self.y * 256
+            for index in stored.get_indices():
+                if index not in proxies:
+                    column = StoredColumn(self, stored, index,
+                                          base_x + index % 256,
+                                          base_y + index // 256)
+                    column._append_deltas(deltas)
+
+    def _get_edited_column(self, index):
+        """Gets the proxy of an edited column if it has been decoded.
+        
+        Keyword arguments:
+        index -- Column index (x + y * 256).
+
+        Returns:
+        The pinned proxy or None.
+
+        """
+        return self.__proxies.get(index)
 
 
 class CuBoltXYProxy:
     def __init__(self, server, chunk, proxy, x, y):
         self.__server = server
+        self.__chunk = chunk
         self.__proxy = proxy
         self.__x = x + chunk.x * 256
         self.__y = y + chunk.y * 256
         self.__chunk_x = chunk.x
         self.__chunk_y = chunk.y
-        self.__blocks = {} # index -> (block_delta_update)
-        self.height = proxy.a + len(proxy) # first not allocated block
+        # Overridden blocks, stored packed: sorted absolute z
+        # coordinates and parallel arrays holding 3 color bytes and
+        # the block type byte per block
+        self.__z = array('i')
+        self.__colors = bytearray()
+        self.__types = bytearray()
+        self.__index = x + y * 256
+
+    @property
+    def height(self):
+        """z coordinate of the first block above this column."""
+        return self.__chunk._get_height(self.__index)
 
     # replaced
     @property
@@ -342,10 +962,27 @@ class CuBoltXYProxy:
         A block.
         
         """
-        if z in self.__blocks:
-            return self.__create_block_from_bdu(self.__blocks[z])
+        i = self.__find(z)
+        if i >= 0:
+            return self.__create_block_from_overlay(i)
         else:
-            return self.__create_block_from_native(z)
+            return self.__get_native_block(z)
+
+    def __find(self, z):
+        """Finds the overlay index of an overridden block.
+        
+        Keyword arguments:
+        z -- Absolute z coordinate.
+
+        Returns:
+        The index or -1 if the block isn't overridden.
+
+        """
+        zs = self.__z
+        i = bisect_left(zs, z)
+        if i < len(zs) and zs[i] == z:
+            return i
+        return -1
 
     def set_block(self, z, block):
         """Absolute block set.
@@ -354,173 +991,1072 @@ class CuBoltXYProxy:
         z -- Absolute z coordinate to write to.
         block -- Block to set.
 
+        """
+        if self.__chunk.released: # the world holds a new chunk
+            self.__server.world.set_block(
+                Vector3(self.__x, self.__y, int(z)), block)
+            return
+        self.__chunk._invalidate([self._set_block(z, block)])
+
+    def _set_block(self, z, block):
+        """Absolute block set without invalidating clients.
+        
+        Keyword arguments:
+        z -- Absolute z coordinate to write to.
+        block -- Block to set.
+
+        Returns:
+        Tuple (x, y, z, column) identifying the changed block.
+
         """
         if z < self.__proxy.a:
             raise IndexBelowWorldException("Blocks below the a index of a chunk can't be set")
 
-        self.__blocks[z] = self.__create_bdu(block, z)
-        if z >= self.height and block.type != EMPTY_TYPE:
-            self.height = z + 1
-        if z == self.height and block.type == EMPTY_TYPE:
-            self.height = self.height - 1
-            while self.get_block(self.height).type == EMPTY_TYPE:
-                self.height = self.height - 1
-            self.height = self.height + 1
-        self.__invalidate(z)
+        if not self.__z:
+            pinned = self.__chunk._pin(self.__index, self)
+            if pinned is not self:
+                return pinned._set_block(z, block)
+
+        zs = self.__z
+        block_type = block.type
+        if block.breakable:
+            block_type |= BREAKABLE_FLAG
+        i = bisect_left(zs, z)
+        if i < len(zs) and zs[i] == z:
+            self.__colors[i * 3:i * 3 + 3] = bytes(block.color)
+            self.__types[i] = block_type
+        else:
+            zs.insert(i, z)
+            self.__colors[i * 3:i * 3] = bytes(block.color)
+            self.__types.insert(i, block_type)
+        chunk = self.__chunk
+        index = self.__index
+        height = chunk._get_height(index)
+        if block.type != EMPTY_TYPE:
+            if z >= height:
+                chunk._set_height(index, z + 1)
+        elif z == height - 1:
+            # the top block was removed, find the new top
+            top = z - 1
+            while self.__get_type(top) == EMPTY_TYPE:
+                top -= 1
+            chunk._set_height(index, top + 1)
+        return (self.__x, self.__y, z, self)
+        
+    def __get_type(self, z):
+        """Gets the type of a block without creating it.
+        
+        Keyword arguments:
+        z -- Absolute z coordinate.
+
+        """
+        i = self.__find(z)
+        if i >= 0:
+            return self.__types[i] & BLOCK_TYPE_MASK
+        proxy = self.__proxy
+        rel_z = z - proxy.a
+        if rel_z < 0:
+            return MOUNTAIN_TYPE
+        if rel_z >= len(proxy):
+            if z <= 0:
+                return WATER_TYPE
+            return EMPTY_TYPE
+        type = proxy.get_type(rel_z)
+        if z <= 0 and type == EMPTY_TYPE:
+            return WATER_TYPE
+        return type
+
+    def _is_solid(self, z):
+        """Checks whether a block is solid. Empty blocks below the sea
+        level aren't solid, blocks below the a index are.
+        
+        Keyword arguments:
+        z -- Absolute z coordinate.
+
+        """
+        i = self.__find(z)
+        if i >= 0:
+            return (self.__types[i] & BLOCK_TYPE_MASK) != EMPTY_TYPE
+        proxy = self.__proxy
+        rel_z = z - proxy.a
+        if rel_z < 0:
+            return True
+        if rel_z >= len(proxy):
+            return False
+        return proxy.get_type(rel_z) != EMPTY_TYPE
+
+    def _get_top(self):
+        """Gets the z coordinate above the highest native or
+        overridden block of this column.
+
+        """
+        proxy = self.__proxy
+        top = proxy.a + len(proxy)
+        if self.__z:
+            top = max(top, self.__z[-1] + 1)
+        return top
+
+    def __create_block_from_overlay(self, i):
+        """Creates a block from the overlay.
+        
+        Keyword arguments:
+        i -- Overlay index of the block.
+
+        """
+        colors = self.__colors
+        color = (colors[i * 3], colors[i * 3 + 1], colors[i * 3 + 2])
+        block_type = self.__types[i]
+        type = block_type & BLOCK_TYPE_MASK
+        breakable = (block_type & BREAKABLE_FLAG) != 0
+        return intern_block(color, type, breakable)
+
+    def __get_native_block(self, z):
+        """Gets a block from native values. Color, type and
+        breakability are determined in one pass.
         
-    def __get_color(self, bdu):
-        """Gets the color from a block delta update.
+        Keyword arguments:
+        z -- Absolute z coordinate.
+
+        """
+        proxy = self.__proxy
+        a = proxy.a
+        if z < a:
+            if z >= proxy.b:
+                return MOUNTAIN_BLOCK
+            return BEDROCK_BLOCK
+        rel_z = z - a
+        if rel_z >= len(proxy):
+            if z <= 0:
+                return WATER_BLOCK
+            return EMPTY_BLOCK
+
+        type = proxy.get_type(rel_z)
+        if type == EMPTY_TYPE:
+            if z <= 0:
+                type = WATER_TYPE
+            return intern_block(proxy[rel_z], type,
+                                proxy.get_breakable(rel_z))
+        return Block(proxy[rel_z], type, proxy.get_breakable(rel_z))
+
+    def _read_column(self, z0, z1, region, offset):
+        """Reads a part of this column into a region.
         
         Keyword arguments:
-        bdu -- Block delta update.
+        z0 -- First absolute z coordinate to read.
+        z1 -- Absolute z coordinate to stop reading at.
+        region -- BlockRegion to fill.
+        offset -- Index of z0 in the region's arrays.
 
         """
-        return (bdu.color_red, bdu.color_green, bdu.color_blue)
+        read_native_column(self.__proxy, z0, z1, region, offset)
+        self._read_overlay(z0, z1, region, offset)
 
-    def __get_type(self, bdu):
-        """Gets the type from a block delta update.
+    def _read_overlay(self, z0, z1, region, offset):
+        """Writes the overridden blocks of a part of this column into a
+        region.
         
         Keyword arguments:
-        bdu -- Block delta update.
+        z0 -- First absolute z coordinate to read.
+        z1 -- Absolute z coordinate to stop reading at.
+        region -- BlockRegion to fill.
+        offset -- Index of z0 in the region's arrays.
 
         """
-        return bdu.block_type & 0b11111
+        types = region.types
+        colors = region.colors
+        breakable = region.breakable
+        zs = self.__z
+        block_colors = self.__colors
+        block_types = self.__types
+        for j in range(bisect_left(zs, z0), bisect_left(zs, z1)):
+            i = offset + zs[j] - z0
+            block_type = block_types[j]
+            types[i] = block_type & BLOCK_TYPE_MASK
+            colors[i * 3:i * 3 + 3] = block_colors[j * 3:j * 3 + 3]
+            breakable[i] = (block_type & BREAKABLE_FLAG) != 0
+
+    def _set_overlay(self, zs, colors, types):
+        """Replaces the overlay of this column.
+        
+        Keyword arguments:
+        zs -- Sorted absolute z coordinates.
+        colors -- 3 color bytes per block.
+        types -- Block type byte per block.
 
-    def __get_breakable(self, bdu):
-        """Gets whether a block is breakable from a block delta update.
+        """
+        self.__z = array('i', zs)
+        self.__colors = bytearray(colors)
+        self.__types = bytearray(types)
+
+        # find the new top
+        proxy = self.__proxy
+        z = proxy.a + len(proxy) - 1
+        if zs:
+            z = max(z, zs[-1])
+        while self.__get_type(z) == EMPTY_TYPE:
+            z -= 1
+        self.__chunk._set_height(self.__index, z + 1)
+
+    def _merge_overlay(self, zs, colors, types):
+        """Merges packed blocks into the overlay of this column, the
+        merged blocks replace existing overrides. Unlike set_block,
+        which raises IndexBelowWorldException, blocks below the a index
+        are dropped with a warning: the edits were queued before the
+        terrain was known and there is no caller left to report to.
         
         Keyword arguments:
-        bdu -- Block delta update.
+        zs -- Sorted absolute z coordinates.
+        colors -- 3 color bytes per block.
+        types -- Block type byte per block.
+
+        Returns:
+        A list of (x, y, z, column) tuples identifying the changed
+        blocks.
 
         """
-        return (bdu.block_type & 0b00100000) != 0
+        a = self.__proxy.a
+        start = bisect_left(zs, a)
+        if start:
+            print('[CB] Dropped %d queued block edits below the world at '
+                  '(%d, %d), lowest z is %d.' % (start, self.__x, self.__y,
+                                                 a))
+        old_zs = self.__z
+        old_colors = self.__colors
+        old_types = self.__types
+        new_zs = array('i')
+        new_colors = bytearray()
+        new_types = bytearray()
+        i = 0
+        count = len(old_zs)
+        for j in range(start, len(zs)):
+            z = zs[j]
+            while i < count and old_zs[i] < z:
+                new_zs.append(old_zs[i])
+                new_colors += old_colors[i * 3:i * 3 + 3]
+                new_types.append(old_types[i])
+                i += 1
+            if i < count and old_zs[i] == z:
+                i += 1
+            new_zs.append(z)
+            new_colors += colors[j * 3:j * 3 + 3]
+            new_types.append(types[j])
+        new_zs.extend(old_zs[i:])
+        new_colors += old_colors[i * 3:]
+        new_types += old_types[i:]
+        self._set_overlay(new_zs, new_colors, new_types)
+
+        x = self.__x
+        y = self.__y
+        return [(x, y, zs[j], self) for j in range(start, len(zs))]
+
+    def _get_overlay(self):
+        """Gets the packed overlay of this column.
+        
+        Returns:
+        Tuple (z coordinates, colors, types) as stored.
 
-    def __create_block_from_bdu(self, bdu):
-        """Creates a block from a block delta update.
+        """
+        return (self.__z, self.__colors, self.__types)
+
+    def _get_delta(self, z):
+        """Creates a block delta update for an overridden block.
         
+        Keyword arguments:
+        z -- Absolute z coordinate.
+
+        Returns:
+        The block delta update.
 
+        """
+        i = self.__find(z)
+        colors = self.__colors
+        return create_block_delta(self.__x, self.__y, z, colors[i * 3],
+                                  colors[i * 3 + 1], colors[i * 3 + 2],
+                                  self.__types[i])
+        
+    def _append_deltas(self, deltas):
+        """Appends the deltas for this chunk.
+        
         Keyword arguments:
-        bdu --  Block delta update.
+        deltas -- BlockDeltaQueue to append to.
 
         """
-        color = self.__get_color(bdu)
-        type = self.__get_type(bdu)
-        breakable = self.__get_breakable(bdu)
-        return Block(color, type, breakable)
+        x = self.__x
+        y = self.__y
+        deltas.extend((x, y, z, self) for z in self.__z)
+
+
+class StoredColumn:
+    """Column of a chunk's stored overlay that hasn't been decoded
+    yet, used to queue its deltas.
 
-    def __get_native_color(self, z):
-        """Gets the native color of a block.
+    """
+    def __init__(self, chunk, overlay, index, x, y):
+        """Creates a new StoredColumn.
+        
+        Keyword arguments:
+        chunk -- CuBoltTGenChunk the column belongs to.
+        overlay -- OverlayView holding the column.
+        index -- Column index (x + y * 256).
+        x -- Absolute x coordinate.
+        y -- Absolute y coordinate.
+
+        """
+        self.__chunk = chunk
+        self.__overlay = overlay
+        self.__index = index
+        self.__x = x
+        self.__y = y
+        self.__z = overlay.get_zs(index)
+
+    def _get_delta(self, z):
+        """Creates a block delta update for an overridden block. If
+        the column has been decoded in the meantime its current state
+        is used.
         
         Keyword arguments:
         z -- Absolute z coordinate.
 
+        Returns:
+        The block delta update.
+
         """
-        a = self.a
-        b = self.b
-        l = len(self.__proxy)
-        if z < b or z >= a + l:
-            return (0,0,0)
-        elif z >= b and z < a:
-            return (128, 128, 128)
+        proxy = self.__chunk._get_edited_column(self.__index)
+        if proxy is not None:
+            return proxy._get_delta(z)
+        i = bisect_left(self.__z, z)
+        red, green, blue, block_type = self.__overlay.get_block_data(
+            self.__index, i)
+        return create_block_delta(self.__x, self.__y, z, red, green, blue,
+                                  block_type)
 
+    def _append_deltas(self, deltas):
+        """Appends the deltas for this column.
+        
+        Keyword arguments:
+        deltas -- BlockDeltaQueue to append to.
+
+        """
+        x = self.__x
+        y = self.__y
+        deltas.extend((x, y, z, self) for z in self.__z)
+
+
+def create_block_delta(x, y, z, red, green, blue, block_type):
+    """Creates a block delta update.
+    
+    Keyword arguments:
+    x -- Absolute x coordinate.
+    y -- Absolute y coordinate.
+    z -- Absolute z coordinate.
+    red -- Red color component.
+    green -- Green color component.
+    blue -- Blue color component.
+    block_type -- Type byte of the block.
+
+    Returns:
+    The block delta update.
+
+    """
+    bdu = BlockDeltaUpdate()
+    # All coordinates are specified absolute in block
+    # coordinates
+    bdu.block_pos = Vector3(x, y, z)
+    bdu.color_red = red
+    bdu.color_green = green
+    bdu.color_blue = blue
+    bdu.block_type = block_type
+    bdu.something8 = 0
+    return bdu
+
+
+def read_native_column(proxy, z0, z1, region, offset):
+    """Reads a part of a native tgen column into a region.
+    
+    Keyword arguments:
+    proxy -- The tgen column.
+    z0 -- First absolute z coordinate to read.
+    z1 -- Absolute z coordinate to stop reading at.
+    region -- BlockRegion to fill.
+    offset -- Index of z0 in the region's arrays.
+
+    """
+    types = region.types
+    colors = region.colors
+    breakable = region.breakable
+    a = proxy.a
+    b = proxy.b
+    top = a + len(proxy)
+
+    def fill(start, end, type, color):
+        start = max(start, z0)
+        end = min(end, z1)
+        if start < end:
+            n = end - start
+            i = offset + start - z0
+            types[i:i + n] = bytes((type,)) * n
+            colors[i * 3:(i + n) * 3] = bytes(color) * n
+
+    fill(z0, b, MOUNTAIN_TYPE, BEDROCK_BLOCK.color)
+    fill(b, a, MOUNTAIN_TYPE, MOUNTAIN_BLOCK.color)
+    fill(top, 1, WATER_TYPE, WATER_BLOCK.color)
+    fill(max(top, 1), z1, EMPTY_TYPE, EMPTY_BLOCK.color)
+
+    # breakable is already False outside of the allocated part
+    for z in range(max(a, z0), min(top, z1)):
         rel_z = z - a
-        return self.__proxy[rel_z]
+        i = offset + z - z0
+        type = proxy.get_type(rel_z)
+        if z <= 0 and type == EMPTY_TYPE:
+            type = WATER_TYPE
+        types[i] = type
+        colors[i * 3:i * 3 + 3] = bytes(proxy[rel_z])
+        breakable[i] = proxy.get_breakable(rel_z)
+
+
+class ChunkVolume:
+    """Dense array representation of a chunk. All arrays are indexed by
+    [x, y, z - z_offset].
+    
+    """
+    def __init__(self, z_offset, types, colors, breakable, solid, bottom):
+        """Creates a new ChunkVolume.
+        
+        Keyword arguments:
+        z_offset -- Absolute z coordinate of index 0.
+        types -- uint8 array of block types.
+        colors -- uint8 array of colors, last axis is (r, g, b).
+        breakable -- bool array of breakability.
+        solid -- bool array of solid blocks.
+        bottom -- int array of the lowest index of each column that
+            is part of the world (the b index).
+
+        """
+        self.z_offset = z_offset
+        self.types = types
+        self.colors = colors
+        self.breakable = breakable
+        self.solid = solid
+        self.bottom = bottom
+
+    def get_surface(self):
+        """Gets the visible surface of the chunk, these are all solid
+        blocks that have at least one non solid neighbor. Blocks
+        outside of the chunk count as non solid, blocks below the
+        volume as solid.
+        
+        Returns:
+        A bool array.
 
-    def __get_native_type(self, z):
-        """Gets the native type of a block.
+        """
+        solid = self.solid
+        padded = numpy.pad(solid, ((1, 1), (1, 1), (0, 0)),
+                           constant_values=False)
+        padded = numpy.pad(padded, ((0, 0), (0, 0), (1, 0)),
+                           constant_values=True)
+        padded = numpy.pad(padded, ((0, 0), (0, 0), (0, 1)),
+                           constant_values=False)
+        hidden = (padded[:-2, 1:-1, 1:-1] & padded[2:, 1:-1, 1:-1] &
+                  padded[1:-1, :-2, 1:-1] & padded[1:-1, 2:, 1:-1] &
+                  padded[1:-1, 1:-1, :-2] & padded[1:-1, 1:-1, 2:])
+        z = numpy.arange(solid.shape[2])
+        in_world = z[None, None, :] >= self.bottom[:, :, None]
+        return solid & ~hidden & in_world
+
+
+class ChunkUnloader:
+    """Unloads chunks no player has been near for some time."""
+    def __init__(self, server, timeout=DEFAULT_UNLOAD_TIMEOUT, radius=2):
+        """Creates a new ChunkUnloader.
         
         Keyword arguments:
-        z -- Absolute z coordinate.
+        server -- Server instance.
+        timeout -- Time in seconds after which a chunk no player has
+            been near is unloaded.
+        radius -- Distance in chunks within which a player keeps a
+            chunk loaded.
 
         """
-        a = self.a
-        b = self.b
-        l = len(self.__proxy)
-        if z < a:
-            return MOUNTAIN_TYPE
-        elif z >= a + l:
-            if z <= 0:
-                return WATER_TYPE
+        self.server = server
+        self.timeout = timeout
+        self.radius = radius
+
+    def update(self):
+        """Checks all chunks and unloads the abandoned ones."""
+        now = time.time()
+        r = self.radius
+        player_chunks = set()
+        for player in self.server.players.values():
+            player_chunks.add(get_chunk_pos(player.entity.pos))
+
+        world = self.server.world
+        unload_keys = []
+        for key, chunk in world.chunks.items():
+            cx, cy = chunk.get_chunk_pos()
+            for px, py in player_chunks:
+                if abs(cx - px) <= r and abs(cy - py) <= r:
+                    chunk.last_visit = now
+                    break
             else:
-                return EMPTY_TYPE
+                if (now - chunk.last_visit > self.timeout and
+                        chunk.can_unload()):
+                    unload_keys.append(key)
 
-        rel_z = z - a
-        native_type = self.__proxy.get_type(rel_z)
-        if z <= 0 and native_type == EMPTY_TYPE:
-            return WATER_TYPE
-        return native_type
+        for key in unload_keys:
+            chunk = world.chunks.pop(key)
+            chunk.unload()
+
+
+class ChunkPrefetcher:
+    """Requests the chunks around and ahead of players before they
+    arrive, so that the chunks are generated and their edits are
+    restored in time.
 
-    def __get_native_breakable(self, z):
-        """Gets whether a block is breakable by native.
+    """
+    def __init__(self, server, radius=DEFAULT_PREFETCH_RADIUS,
+                 lookahead=DEFAULT_PREFETCH_LOOKAHEAD,
+                 max_pending=DEFAULT_MAX_PENDING_CHUNKS):
+        """Creates a new ChunkPrefetcher.
         
         Keyword arguments:
+        server -- Server instance.
+        radius -- Radius in chunks of the ring around each player.
+        lookahead -- Time in seconds the movement of a player is
+            extrapolated.
+        max_pending -- Maximum number of chunks being generated at
+            once.
+
+        """
+        self.server = server
+        self.radius = radius
+        self.lookahead = lookahead
+        self.max_pending = max_pending
+        self.__queue = [] # [(chunk x, chunk y)], nearest last
+        self.__pending = {} # (chunk x, chunk y) -> chunk being generated
+
+    def get_pending_count(self):
+        """Gets the number of chunks currently being generated.
+        
+        Returns:
+        The number of chunks.
+
+        """
+        return len(self.__pending)
+
+    def update(self):
+        """Collects the chunks wanted by all players and requests as
+        many as the concurrency limit allows.
+
+        """
+        r = self.radius
+        wanted = {} # (chunk x, chunk y) -> distance to the nearest player
+        for player in self.server.players.values():
+            entity = player.entity
+            cx, cy = get_chunk_pos(entity.pos)
+            centers = [(cx, cy)]
+            velocity = entity.velocity
+            ahead = Vector2(entity.pos.x + velocity.x * self.lookahead,
+                            entity.pos.y + velocity.y * self.lookahead)
+            ahead = get_chunk_pos(ahead)
+            if ahead != (cx, cy):
+                centers.append(ahead)
+            for center_x, center_y in centers:
+                for x in range(center_x - r, center_x + r + 1):
+                    for y in range(center_y - r, center_y + r + 1):
+                        distance = max(abs(x - cx), abs(y - cy))
+                        if wanted.get((x, y), distance) >= distance:
+                            wanted[(x, y)] = distance
+
+        # drop the chunks that are generated or have been unloaded
+        # before being generated
+        chunks = self.server.world.chunks
+        pending = self.__pending
+        for pos in [pos for pos, chunk in pending.items()
+                    if chunk.data is not None or
+                    chunks.get(chunk.pos) is not chunk]:
+            del pending[pos]
+
+        queue = [pos for pos in wanted if pos not in pending]
+        queue.sort(key=wanted.__getitem__, reverse=True)
+        self.__queue = queue
+        self.__request()
+
+    def __request(self):
+        """Requests queued chunks until the concurrency limit is
+        reached.
+
+        """
+        world = self.server.world
+        queue = self.__queue
+        pending = self.__pending
+        while queue and len(pending) < self.max_pending:
+            pos = queue.pop()
+            # get_chunk returns the existing chunk if it has been
+            # requested before
+            chunk = world.get_chunk(Vector2(*pos))
+            if chunk.data is None:
+                pending[pos] = chunk
+
+
+class ProxyCache:
+    """Server wide LRU cache of column proxies without edits. Bounds
+    the number of proxies kept for reading.
+    
+    """
+    def __init__(self, max_size=DEFAULT_PROXY_CACHE_SIZE):
+        """Creates a new ProxyCache.
+        
+        Keyword arguments:
+        max_size -- Maximum number of cached proxies.
+
+        """
+        self.max_size = max_size
+        self.__proxies = OrderedDict() # (chunk x, chunk y, index) -> proxy
+        self.__chunks = {} # (chunk x, chunk y) -> {index}
+
+    def __len__(self):
+        return len(self.__proxies)
+
+    def get(self, key):
+        """Gets a proxy and marks it as recently used.
+        
+        Keyword arguments:
+        key -- Tuple (chunk x, chunk y, column index).
+
+        Returns:
+        The proxy or None if it isn't cached.
+
+        """
+        proxy = self.__proxies.get(key)
+        if proxy is not None:
+            self.__proxies.move_to_end(key)
+        return proxy
+
+    def put(self, key, proxy):
+        """Caches a proxy, evicting the least recently used ones if the
+        cache is full.
+        
+        Keyword arguments:
+        key -- Tuple (chunk x, chunk y, column index).
+        proxy -- The proxy.
+
+        """
+        proxies = self.__proxies
+        if key not in proxies:
+            chunk_pos = (key[0], key[1])
+            indices = self.__chunks.get(chunk_pos)
+            if indices is None:
+                indices = set()
+                self.__chunks[chunk_pos] = indices
+            indices.add(key[2])
+        proxies[key] = proxy
+        while len(proxies) > self.max_size:
+            old_key, _ = proxies.popitem(last=False)
+            self.__forget(old_key)
+
+    def remove(self, key):
+        """Removes a proxy from the cache if it is cached.
+        
+        Keyword arguments:
+        key -- Tuple (chunk x, chunk y, column index).
+
+        """
+        if self.__proxies.pop(key, None) is not None:
+            self.__forget(key)
+
+    def remove_chunk(self, chunk_pos):
+        """Removes all proxies of a chunk.
+        
+        Keyword arguments:
+        chunk_pos -- Tuple (chunk x, chunk y).
+
+        """
+        indices = self.__chunks.pop(chunk_pos, ())
+        x, y = chunk_pos
+        for index in indices:
+            del self.__proxies[(x, y, index)]
+
+    def get_count(self, chunk_pos):
+        """Gets the number of cached proxies of a chunk.
+        
+        Keyword arguments:
+        chunk_pos -- Tuple (chunk x, chunk y).
+
+        Returns:
+        The number of proxies.
+
+        """
+        return len(self.__chunks.get(chunk_pos, ()))
+
+    def __forget(self, key):
+        chunk_pos = (key[0], key[1])
+        indices = self.__chunks[chunk_pos]
+        indices.discard(key[2])
+        if not indices:
+            del self.__chunks[chunk_pos]
+
+
+class BlockRegion:
+    """Columnar snapshot of the blocks within a box. Blocks are stored
+    in flat arrays, the index of a block is
+    ((x - self.x) * size_y + (y - self.y)) * size_z + (z - self.z).
+    Colors take 3 bytes per block.
+    
+    """
+    def __init__(self, x, y, z, size_x, size_y, size_z):
+        """Creates a new empty BlockRegion.
+        
+        Keyword arguments:
+        x -- Lowest absolute x coordinate.
+        y -- Lowest absolute y coordinate.
+        z -- Lowest absolute z coordinate.
+        size_x -- Size in x direction.
+        size_y -- Size in y direction.
+        size_z -- Size in z direction.
+
+        """
+        self.x = x
+        self.y = y
+        self.z = z
+        self.size_x = size_x
+        self.size_y = size_y
+        self.size_z = size_z
+        count = size_x * size_y * size_z
+        self.types = bytearray(count)
+        self.colors = bytearray(count * 3)
+        self.breakable = bytearray(count)
+        # chunks that were not loaded, their blocks are left empty
+        self.missing_chunks = []
+
+    def get_index(self, x, y, z):
+        """Gets the array index of a block.
+        
+        Keyword arguments:
+        x -- Absolute x coordinate.
+        y -- Absolute y coordinate.
         z -- Absolute z coordinate.
 
+        Returns:
+        The index.
+
         """
-        a = self.a
-        b = self.b
-        l = len(self.__proxy)
-        if z < a or z >= a + l:
-            return False
+        return (((x - self.x) * self.size_y + (y - self.y)) * self.size_z +
+                (z - self.z))
+
+    def get_column(self, x, y):
+        """Gets the block types of a column without copying.
         
-        rel_z = z - a
-        return self.__proxy.get_breakable(rel_z)
+        Keyword arguments:
+        x -- Absolute x coordinate.
+        y -- Absolute y coordinate.
 
-    def __create_block_from_native(self, z):
-        """Creates a block from native values.
+        Returns:
+        A memoryview of the types, index 0 is at z = self.z.
+
+        """
+        i = self.get_index(x, y, self.z)
+        return memoryview(self.types)[i:i + self.size_z]
+
+    def get_block(self, x, y, z):
+        """Gets a block.
         
         Keyword arguments:
+        x -- Absolute x coordinate.
+        y -- Absolute y coordinate.
         z -- Absolute z coordinate.
 
+        Returns:
+        The block.
+
         """
-        color = self.__get_native_color(z)
-        type = self.__get_native_type(z)
-        breakable = self.__get_native_breakable(z)
-        return Block(color, type, breakable)
+        i = self.get_index(x, y, z)
+        colors = self.colors
+        color = (colors[i * 3], colors[i * 3 + 1], colors[i * 3 + 2])
+        return intern_block(color, self.types[i], self.breakable[i] != 0)
+
 
-    def __create_bdu(self, block, z):
-        """Creates a block delta update.
+class BlockEditLog:
+    """Edits of a chunk that hasn't been loaded yet. Only the last edit
+    of each position is kept. As the terrain isn't known yet, edits
+    below the world aren't rejected here but dropped with a warning
+    when the chunk is loaded.
+
+    """
+    def __init__(self):
+        """Creates a new BlockEditLog."""
+        self.__columns = {} # index -> {z: block}
+
+    def __len__(self):
+        return sum(len(blocks) for blocks in self.__columns.values())
+
+    def __bool__(self):
+        return bool(self.__columns)
+
+    def add(self, x, y, z, block):
+        """Adds an edit.
         
         Keyword arguments:
-        block -- The block to create it from.
+        x -- X chunk coordinate (0-255).
+        y -- Y chunk coordinate (0-255).
         z -- Absolute z coordinate.
+        block -- Block to set.
 
         """
-        bdu = BlockDeltaUpdate()
-        # All coordinates are specified absolute in block
-        # coordinates
-        bdu.block_pos = Vector3(self.__x, self.__y, z)
-        bdu.color_red, bdu.color_green, bdu.color_blue = block.color
-        bdu.block_type = block.type | (block.breakable << 6)
-        bdu.something8 = 0
-        return bdu
+        index = x + y * 256
+        blocks = self.__columns.get(index)
+        if blocks is None:
+            blocks = {}
+            self.__columns[index] = blocks
+        blocks[z] = block
+
+    def extend(self, blocks):
+        """Adds multiple edits.
         
-    def __invalidate(self, z):
-        """Invalidates this block. This means that it will be
-        retransferred as soon as possible.
+        Keyword arguments:
+        blocks -- Iterable of ((x, y, z), block) tuples. X, Y
+            coordinates from 0-255.
+
+        """
+        columns = self.__columns
+        for (x, y, z), block in blocks:
+            index = int(x) + int(y) * 256
+            column = columns.get(index)
+            if column is None:
+                column = {}
+                columns[index] = column
+            column[int(z)] = block
+
+    def get_columns(self):
+        """Packs the edits by column.
+        
+        Returns:
+        A generator yielding (index, zs, colors, types) tuples in the
+        format of the column overlays.
+
+        """
+        for index, blocks in self.__columns.items():
+            zs = array('i', sorted(blocks))
+            colors = bytearray()
+            types = bytearray()
+            for z in zs:
+                block = blocks[z]
+                colors += bytes(block.color)
+                block_type = block.type
+                if block.breakable:
+                    block_type |= BREAKABLE_FLAG
+                types.append(block_type)
+            yield (index, zs, colors, types)
+
+
+class BlockDeltaQueue:
+    """Queue of blocks waiting to be sent to a client. The blocks are
+    bucketed by chunk, kept in insertion order and keyed by block
+    position, so each block is only queued once. The block delta
+    updates are created from the columns when they are removed from
+    the queue, so they always carry the latest state of a block.
+    
+    """
+    def __init__(self):
+        """Creates a new BlockDeltaQueue."""
+        # (chunk x, chunk y) -> {(x, y, z) -> column}
+        self.__chunks = {}
+        self.__count = 0
+
+    def __len__(self):
+        return self.__count
+
+    def __contains__(self, position):
+        x, y, z = position
+        deltas = self.__chunks.get((x // 256, y // 256))
+        return deltas is not None and (x, y, z) in deltas
+
+    def add(self, x, y, z, column):
+        """Adds a block. A queued block keeps its place in the queue.
+        
+        Keyword arguments:
+        x -- Absolute x coordinate.
+        y -- Absolute y coordinate.
+        z -- Absolute z coordinate.
+        column -- CuBoltXYProxy holding the block.
+
+        """
+        chunk_pos = (x // 256, y // 256)
+        deltas = self.__chunks.get(chunk_pos)
+        if deltas is None:
+            deltas = OrderedDict()
+            self.__chunks[chunk_pos] = deltas
+        key = (x, y, z)
+        if key not in deltas:
+            self.__count += 1
+        deltas[key] = column
+
+    def extend(self, blocks):
+        """Adds multiple blocks.
         
         Keyword arguments:
-        z -- Absolute z index of block to invalidate.
+        blocks -- Iterable of (x, y, z, column) tuples.
 
         """
-        cubolt = self.__server.scripts.cubolt
-        for con_script in cubolt.children:
-            if con_script.is_near(self.__chunk_x, self.__chunk_y):
-                bdu = self.__blocks[z]
-                if bdu not in con_script.block_deltas:
-                    con_script.block_deltas.append(self.__blocks[z])
+        for x, y, z, column in blocks:
+            self.add(x, y, z, column)
+
+    def pop_many(self, count, near=None):
+        """Removes blocks from the queue and creates their block delta
+        updates. Blocks of chunks closer to near are removed first,
+        within a chunk the oldest blocks are removed first.
+        
+        Keyword arguments:
+        count -- Maximum number of blocks to remove.
+        near -- Tuple (chunk x, chunk y) to prioritize, None to remove
+            the chunks in insertion order.
+
+        Returns:
+        A list of block delta updates.
+
+        """
+        chunks = self.__chunks
+        if near is None:
+            chunk_order = list(chunks)
+        else:
+            nx, ny = near
+            chunk_order = sorted(chunks, key=lambda c:
+                                 (c[0] - nx) ** 2 + (c[1] - ny) ** 2)
+
+        result = []
+        for chunk_pos in chunk_order:
+            remaining = count - len(result)
+            if remaining <= 0:
+                break
+            deltas = chunks[chunk_pos]
+            if remaining >= len(deltas):
+                result.extend(column._get_delta(key[2])
+                              for key, column in deltas.items())
+                del chunks[chunk_pos]
+            else:
+                popitem = deltas.popitem
+                for _ in range(remaining):
+                    key, column = popitem(last=False)
+                    result.append(column._get_delta(key[2]))
+        self.__count -= len(result)
+        return result
+
+    def clear(self):
+        """Removes all blocks."""
+        self.__chunks.clear()
+        self.__count = 0
+
+
+class BlockEditTransaction:
+    """Collects block edits and applies them at once. Use it as a
+    context manager, the edits are committed when the block is left
+    without an exception.
     
-    def _append_deltas(self, deltas):
-        """Appends the deltas for this chunk.
+    """
+    def __init__(self, world):
+        """Creates a new BlockEditTransaction.
+        
+        Keyword arguments:
+        world -- World to edit.
+
+        """
+        self.world = world
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+    def set_block(self, position, block):
+        """Sets a block when the transaction is committed.
         
         Keyword arguments:
-        deltas -- List to append to.
+        position -- Absolute position in block coordinates.
+        block -- Block to set.
 
         """
-        deltas.extend(self.__blocks.values())
+        p = position
+        self.blocks.append(((int(p.x), int(p.y), int(p.z)), block))
+
+    def commit(self):
+        """Applies all collected edits."""
+        blocks = self.blocks
+        self.blocks = []
+        self.world.set_blocks(blocks)
+
 
 class Block:
+    """Immutable block value. Blocks can be compared and hashed, use
+    intern_block to get shared instances of common blocks.
+    
+    """
+    __slots__ = ('color', 'type', 'breakable')
+
     def __init__(self, color=(0,0,0), type=EMPTY_TYPE, breakable=False):
-        self.color = color
-        self.type = type
-        self.breakable = breakable
\ No newline at end of file
+        """Creates a new Block.
+        
+        Keyword arguments:
+        color -- Tuple (red, green, blue).
+        type -- Block type.
+        breakable -- True if the block is breakable.
+
+        """
+        object.__setattr__(self, 'color', tuple(color))
+        object.__setattr__(self, 'type', type)
+        object.__setattr__(self, 'breakable', bool(breakable))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Blocks are immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('Blocks are immutable')
+
+    def __eq__(self, other):
+        if not isinstance(other, Block):
+            return NotImplemented
+        return (self.color == other.color and self.type == other.type and
+                self.breakable == other.breakable)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash((self.color, self.type, self.breakable))
+
+    def __repr__(self):
+        return 'Block(%r, %r, %r)' % (self.color, self.type, self.breakable)
+
+
+EMPTY_BLOCK = Block((0, 0, 0), EMPTY_TYPE, False)
+WATER_BLOCK = Block((0, 0, 0), WATER_TYPE, False)
+MOUNTAIN_BLOCK = Block((128, 128, 128), MOUNTAIN_TYPE, False)
+BEDROCK_BLOCK = Block((0, 0, 0), MOUNTAIN_TYPE, False) # below b
+
+
+INTERNED_BLOCKS = {
+    (block.color, block.type, block.breakable) : block
+    for block in (EMPTY_BLOCK, WATER_BLOCK, MOUNTAIN_BLOCK, BEDROCK_BLOCK)
+}
+
+
+def intern_block(color, type, breakable):
+    """Gets a block, common blocks are shared instances.
+    
+    Keyword arguments:
+    color -- Tuple (red, green, blue).
+    type -- Block type.
+    breakable -- True if the block is breakable.
+
+    Returns:
+    The block.
+
+    """
+    block = INTERNED_BLOCKS.get((tuple(color), type, breakable))
+    if block is None:
+        block = Block(color, type, breakable)
+    return block